@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+from telegram import Chat, ChatMember
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+ADMIN_STATUSES = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+class ChatAdmins:
+    """Who may manage points in each chat, kept in memory.
+
+    A chat's admins are its Telegram administrators plus the users on its
+    allow-list in the database. The set is loaded on first use and then
+    served from a TTL cache; once an entry is older than ``refresh_after``
+    seconds the next lookup still answers from it and reloads it in the
+    background. Entries are dropped outright after ``max_age`` seconds or
+    when ``invalidate`` is called for a chat-member update.
+    """
+
+    def __init__(self, db, refresh_after: float = 300, max_age: float = 3600,
+                 maxsize: int = 10000):
+        self.db = db
+        self.refresh_after = refresh_after
+        # chat_id -> (Telegram admin IDs, allow-listed IDs, monotonic time they were loaded)
+        self._cache = TTLCache(maxsize, max_age)
+        self._loading = {}
+        # Bumped by invalidate so a load that was already running doesn't
+        # put the old list back
+        self._versions = {}
+
+    async def _fetch(self, bot, chat: Chat) -> tuple:
+        allowed = frozenset(await self.db.get_chat_admin_ids(chat.id))
+        # Private chats have no administrator list
+        if chat.type == Chat.PRIVATE:
+            return frozenset(), allowed
+        members = await bot.get_chat_administrators(chat.id)
+        return frozenset(member.user.id for member in members if not member.user.is_bot), allowed
+
+    async def _load(self, bot, chat: Chat) -> tuple:
+        version = self._versions.get(chat.id, 0)
+        telegram_admins, allowed = await self._fetch(bot, chat)
+        if self._versions.get(chat.id, 0) == version:
+            self._cache.set(chat.id, (telegram_admins, allowed, time.monotonic()))
+        return telegram_admins, allowed
+
+    def _start_load(self, bot, chat: Chat) -> asyncio.Task:
+        # Concurrent lookups for the same chat share one load
+        task = self._loading.get(chat.id)
+        if task is None:
+            task = asyncio.create_task(self._load(bot, chat))
+            self._loading[chat.id] = task
+            task.add_done_callback(lambda _: self._forget_load(chat.id, task))
+        return task
+
+    def _forget_load(self, chat_id: int, task: asyncio.Task):
+        # invalidate may already have replaced it with a newer load
+        if self._loading.get(chat_id) is task:
+            del self._loading[chat_id]
+
+    def _refresh_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Error refreshing chat admins: %s", task.exception())
+
+    async def get(self, bot, chat: Chat) -> tuple:
+        """Return the IDs of the chat's Telegram administrators and of its allow-list"""
+        entry = self._cache.get(chat.id)
+        if entry is None:
+            # Shielded so one cancelled caller doesn't cancel the load for the rest
+            return await asyncio.shield(self._start_load(bot, chat))
+
+        telegram_admins, allowed, loaded_at = entry
+        if time.monotonic() - loaded_at >= self.refresh_after and chat.id not in self._loading:
+            self._start_load(bot, chat).add_done_callback(self._refresh_done)
+        return telegram_admins, allowed
+
+    async def is_admin(self, bot, chat: Chat, user_id: int) -> bool:
+        """Check if user may manage points in the chat"""
+        telegram_admins, allowed = await self.get(bot, chat)
+        return user_id in telegram_admins or user_id in allowed
+
+    async def is_chat_administrator(self, bot, chat: Chat, user_id: int) -> bool:
+        """Check if user is one of the chat's Telegram administrators"""
+        telegram_admins, _ = await self.get(bot, chat)
+        return user_id in telegram_admins
+
+    def invalidate(self, chat_id: int):
+        """Forget the chat's admins so the next lookup reloads them"""
+        self._cache.pop(chat_id)
+        self._loading.pop(chat_id, None)
+        self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
@@ -0,0 +1,286 @@
+"""Offline benchmarks for the bot's hot paths.
+
+Drives the real Application and handlers from bot.py with synthetic
+updates. Bot API calls are answered in-process by FakeBotAPI, and the
+database is whatever DATABASE_URL points to (use a local, throwaway one:
+the benchmark deletes every row in the bot's tables).
+
+    DATABASE_URL=postgresql://postgres@localhost/points_bench?sslmode=disable \\
+        python -m benchmarks.bench --chats 1,10,100 --members 100,1000
+    python -m benchmarks.bench --database-url sqlite:////tmp/points_bench.db
+
+For every (chats, members) combination it reports:
+
+- messages/sec through handle_user_message
+- p50/p99 latency of /top and of each step of the /a admin flow
+- database queries per update for each scenario
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from collections import defaultdict
+
+ADMIN_ID = 424242
+BOT_TOKEN = "123456:benchmark"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--chats", default="1,10", help="comma separated chat counts")
+    parser.add_argument("--members", default="100,1000", help="comma separated members per chat")
+    parser.add_argument("--messages", type=int, default=5000, help="tracked messages per run")
+    parser.add_argument("--top-calls", type=int, default=500, help="/top calls per run")
+    parser.add_argument("--admin-flows", type=int, default=50, help="/a flows per run")
+    parser.add_argument("--api-latency", type=float, default=0.0,
+                        help="simulated Bot API round trip in seconds")
+    parser.add_argument("--database-url", help="overrides DATABASE_URL")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def format_latency(samples: list) -> str:
+    if not samples:
+        return "n/a"
+    return (f"p50 {percentile(samples, 0.5) * 1000:.2f} ms, "
+            f"p99 {percentile(samples, 0.99) * 1000:.2f} ms")
+
+class UpdateFactory:
+    """Builds Bot API update payloads"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.next_update_id = 1
+        self.next_message_id = 1
+
+    def _ids(self):
+        self.next_update_id += 1
+        self.next_message_id += 1
+        return self.next_update_id, self.next_message_id
+
+    @staticmethod
+    def _user(user_id: int, username: str) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": username, "username": username}
+
+    @staticmethod
+    def _chat(chat_id: int) -> dict:
+        return {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"}
+
+    def message(self, chat_id: int, user_id: int, username: str, text: str):
+        from telegram import Update
+        update_id, message_id = self._ids()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": self._chat(chat_id),
+            "from": self._user(user_id, username),
+            "text": text
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return Update.de_json({"update_id": update_id, "message": message}, self.bot)
+
+    def callback(self, chat_id: int, user_id: int, username: str, data: str):
+        from telegram import Update
+        update_id, message_id = self._ids()
+        return Update.de_json({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id, username),
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": self._chat(chat_id),
+                    "from": {"id": 1, "is_bot": True, "first_name": "PointsBot"},
+                    "text": "menu"
+                }
+            }
+        }, self.bot)
+
+async def run(args):
+    # Imported here so the environment is in place before config/database load
+    import bot
+    import config
+    import database
+    import handlers
+    import logs
+    from benchmarks.fake_bot_api import FakeBotAPI
+    from leaderboard import LeaderboardCache
+    from scheduler import ChatOrderedUpdateProcessor
+    from sqlalchemy import delete, event
+
+    class TimedUpdateProcessor(ChatOrderedUpdateProcessor):
+        """Records how long each update takes from enqueue to completion"""
+
+        def __init__(self, *processor_args):
+            super().__init__(*processor_args)
+            self.enqueued = {}
+            self.latencies = defaultdict(list)
+
+        async def do_process_update(self, update, coroutine):
+            try:
+                await super().do_process_update(update, coroutine)
+            finally:
+                kind, started = self.enqueued.pop(update.update_id, (None, None))
+                if kind is not None:
+                    self.latencies[kind].append(time.perf_counter() - started)
+
+    logs.setup("WARNING")
+    queries = 0
+
+    def count_query(conn, cursor, statement, *_):
+        nonlocal queries
+        # SQLite transactions are opened with an explicit BEGIN statement
+        if not statement.startswith("BEGIN"):
+            queries += 1
+
+    api = FakeBotAPI(args.api_latency)
+    processor = TimedUpdateProcessor(config.MAX_CONCURRENT_UPDATES, config.MAX_PENDING_UPDATES)
+    application = bot.build_application(request=api, update_processor=processor)
+    updates = UpdateFactory(application.bot)
+    rng = random.Random(args.seed)
+
+    async def submit(kind: str, update):
+        processor.enqueued[update.update_id] = (kind, time.perf_counter())
+        await application.update_queue.put(update)
+
+    async def drain():
+        await application.update_queue.join()
+        await handlers.tracking_buffer.flush()
+        await handlers.db.ledger.flush()
+
+    async def reset(chats: int, members: int):
+        async with database.get_db() as session:
+            for model in (database.PointEvent, database.PointSnapshot, database.UserPoints,
+                          database.ChatSeason):
+                await session.execute(delete(model))
+        handlers.member_cache.clear()
+        handlers.db.seasons.clear()
+        handlers.db.leaderboard = LeaderboardCache()
+
+        chat_ids = [-1_000_000 - index for index in range(chats)]
+        for chat_id in chat_ids:
+            rows = [(chat_id, user_id, f"member{user_id}") for user_id in range(1, members + 1)]
+            for start in range(0, len(rows), 1000):
+                await handlers.db.upsert_members(rows[start:start + 1000])
+            events = [{
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "delta": rng.randint(0, 500),
+                "username": None,
+                "actor_id": ADMIN_ID
+            } for user_id in range(1, members + 1)]
+            for start in range(0, len(events), 1000):
+                await handlers.db.apply_point_events(events[start:start + 1000])
+        # Start from a cold leaderboard, as after a restart
+        handlers.db.leaderboard = LeaderboardCache()
+        return chat_ids
+
+    async def bench_messages(chat_ids: list, members: int) -> dict:
+        nonlocal queries
+        queries = 0
+        started = time.perf_counter()
+        for _ in range(args.messages):
+            user_id = rng.randint(1, members)
+            await submit("message", updates.message(
+                rng.choice(chat_ids), user_id, f"member{user_id}", "hello"
+            ))
+        await drain()
+        elapsed = time.perf_counter() - started
+        return {
+            "messages/sec": f"{args.messages / elapsed:,.0f}",
+            "queries/update": f"{queries / args.messages:.3f}"
+        }
+
+    async def bench_top(chat_ids: list) -> dict:
+        nonlocal queries
+        queries = 0
+        processor.latencies["top"].clear()
+        for _ in range(args.top_calls):
+            await submit("top", updates.message(rng.choice(chat_ids), 7, "member7", "/top"))
+            # Points keep changing between /top bursts
+            if rng.random() < 0.1:
+                await handlers.db.add_points(rng.choice(chat_ids), rng.randint(1, 50), 5)
+        await drain()
+        return {
+            "/top": format_latency(processor.latencies["top"]),
+            "queries/update": f"{queries / args.top_calls:.3f}"
+        }
+
+    async def bench_admin(chat_ids: list, members: int) -> dict:
+        nonlocal queries
+        queries = 0
+        processor.latencies["admin"].clear()
+        flow_times = []
+        steps = 0
+        for _ in range(args.admin_flows):
+            chat_id = rng.choice(chat_ids)
+            target = f"member{rng.randint(1, members)}"
+            flow = [
+                updates.message(chat_id, ADMIN_ID, "admin", "/a"),
+                updates.callback(chat_id, ADMIN_ID, "admin", "add"),
+                updates.callback(chat_id, ADMIN_ID, "admin", f"user_{target}"),
+                updates.message(chat_id, ADMIN_ID, "admin", str(rng.randint(1, 20))),
+                updates.callback(chat_id, ADMIN_ID, "admin", "finish")
+            ]
+            started = time.perf_counter()
+            for update in flow:
+                # Each step waits for the previous reply, as a real admin would
+                await submit("admin", update)
+                await application.update_queue.join()
+            flow_times.append(time.perf_counter() - started)
+            steps += len(flow)
+        await drain()
+        return {
+            "admin step": format_latency(processor.latencies["admin"]),
+            "admin flow": format_latency(flow_times),
+            "queries/update": f"{queries / steps:.3f}"
+        }
+
+    await application.initialize()
+    await bot.post_init(application)
+    # The engines only exist once post_init has connected
+    for engine in {database.engine, database.read_engine}:
+        event.listen(engine.sync_engine, "before_cursor_execute", count_query)
+    await application.start()
+    try:
+        for chats in [int(value) for value in args.chats.split(",")]:
+            for members in [int(value) for value in args.members.split(",")]:
+                chat_ids = await reset(chats, members)
+                print(f"\n== {chats} chats x {members} members ==")
+                for name, scenario in (
+                    ("messages", bench_messages(chat_ids, members)),
+                    ("top", bench_top(chat_ids)),
+                    ("admin", bench_admin(chat_ids, members))
+                ):
+                    results = await scenario
+                    print(f"  {name:<9}" + "  ".join(f"{key}: {value}" for key, value in results.items()))
+                cache = handlers.member_cache.stats()
+                print(f"  member cache hit rate {cache['hit_rate']:.1%}, "
+                      f"Bot API calls {sum(api.calls.values())}")
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await bot.post_shutdown(application)
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("BOT_TOKEN", BOT_TOKEN)
+    os.environ["ADMIN_USER_ID"] = str(ADMIN_ID)
+    # Measure the bot itself, not Telegram's flood limits
+    for name in ("OUTBOX_GLOBAL_RATE", "OUTBOX_CHAT_RATE", "OUTBOX_CHAT_BURST"):
+        os.environ.setdefault(name, "1e9")
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import time
+from collections import Counter
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "PointsBot", "username": "points_bot"}
+ADMIN_RIGHTS = (
+    "can_be_edited", "is_anonymous", "can_manage_chat", "can_delete_messages",
+    "can_manage_video_chats", "can_restrict_members", "can_promote_members",
+    "can_change_info", "can_invite_users", "can_post_stories", "can_edit_stories",
+    "can_delete_stories"
+)
+
+class FakeBotAPI(BaseRequest):
+    """In-process stand-in for the Telegram Bot API.
+
+    Answers every Bot API call the handlers make with a plausible result
+    instead of going over the network, and counts the calls per method.
+    ``latency`` adds a fixed delay to each call to mimic a real round trip.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        # method -> parameters of its latest call
+        self.last_parameters = {}
+        # chat_id -> user IDs returned by getChatAdministrators
+        self.chat_administrators = {}
+        self._next_message_id = 1_000_000
+
+    async def initialize(self):
+        """Nothing to set up"""
+
+    async def shutdown(self):
+        """Nothing to tear down"""
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def _message(self, parameters: dict) -> dict:
+        self._next_message_id += 1
+        message_id = int(parameters.get("message_id") or self._next_message_id)
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(parameters.get("chat_id", 0)), "type": "supergroup"},
+            "from": BOT_USER,
+            "text": parameters.get("text", "")
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        parameters = request_data.parameters if request_data else {}
+        self.last_parameters[api_method] = parameters
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method.startswith("send") or api_method.startswith("edit"):
+            result = self._message(parameters)
+        elif api_method == "getChatAdministrators":
+            result = [{
+                "status": "administrator",
+                "user": {"id": user_id, "is_bot": False, "first_name": f"Admin {user_id}"},
+                **{right: True for right in ADMIN_RIGHTS}
+            } for user_id in self.chat_administrators.get(int(parameters["chat_id"]), [])]
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
@@ -0,0 +1,120 @@
+"""End-to-end check of webhook mode against a fake Telegram.
+
+Starts the real Application from bot.py with the same webhook server
+settings as BOT_MODE=webhook, answers Bot API calls with FakeBotAPI and
+POSTs Update JSON to WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH the way
+Telegram does. Exits non-zero if any check fails:
+
+- setWebhook is called with WEBHOOK_URL/WEBHOOK_PATH and the secret token
+- an update with the right X-Telegram-Bot-Api-Secret-Token reaches the handlers
+- a wrong or missing secret gets 403 and never reaches them
+- a request to another path gets 404
+
+    python -m benchmarks.webhook_check
+    python -m benchmarks.webhook_check --database-url sqlite:////tmp/points_webhook.db
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+BOT_TOKEN = "123456:webhook-check"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+CHAT_ID = -100_500
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--database-url", default="sqlite://",
+                        help="overrides DATABASE_URL (in-memory SQLite by default)")
+    parser.add_argument("--port", type=int, default=8843, help="overrides WEBHOOK_PORT")
+    return parser.parse_args()
+
+async def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+async def run() -> list:
+    # Imported here so the environment is in place before config/database load
+    import httpx
+    import bot
+    import config
+    import logs
+    from benchmarks.bench import UpdateFactory
+    from benchmarks.fake_bot_api import FakeBotAPI
+
+    logs.setup("WARNING")
+    failures = []
+
+    def check(ok: bool, description: str):
+        print(f"{'ok  ' if ok else 'FAIL'} {description}")
+        if not ok:
+            failures.append(description)
+
+    api = FakeBotAPI()
+    application = bot.build_application(request=api)
+    updates = UpdateFactory(application.bot)
+    settings = bot.webhook_settings()
+    address = f"http://127.0.0.1:{config.WEBHOOK_PORT}"
+
+    await application.initialize()
+    await bot.post_init(application)
+    await application.updater.start_webhook(**settings)
+    await application.start()
+    try:
+        registered = api.last_parameters.get("setWebhook", {})
+        check(registered.get("url") == f"{config.WEBHOOK_URL}/{config.WEBHOOK_PATH}",
+              f"setWebhook url is {registered.get('url')!r}")
+        check(registered.get("secret_token") == config.WEBHOOK_SECRET,
+              "setWebhook got WEBHOOK_SECRET as secret_token")
+
+        def help_update() -> dict:
+            return updates.message(CHAT_ID, 1001, "webhook_user", "/help").to_dict()
+
+        async with httpx.AsyncClient(base_url=address) as client:
+            url = f"/{config.WEBHOOK_PATH}"
+            # Rejected requests go first: the accepted one is in the same
+            # chat, so once it is answered the others would have been too
+            response = await client.post(url, json=help_update(),
+                                         headers={SECRET_HEADER: "not-the-secret"})
+            check(response.status_code == 403, f"wrong secret gets {response.status_code}")
+            response = await client.post(url, json=help_update())
+            check(response.status_code == 403, f"missing secret gets {response.status_code}")
+            response = await client.post("/not-the-path", json=help_update(),
+                                         headers={SECRET_HEADER: config.WEBHOOK_SECRET})
+            check(response.status_code == 404, f"wrong path gets {response.status_code}")
+
+            response = await client.post(url, json=help_update(),
+                                         headers={SECRET_HEADER: config.WEBHOOK_SECRET})
+            check(response.status_code == 200, f"valid update gets {response.status_code}")
+            answered = await wait_for(lambda: api.calls["sendMessage"] >= 1)
+            check(answered, "valid /help update reached the handler")
+            await asyncio.sleep(0.5)
+            check(api.calls["sendMessage"] == 1,
+                  f"{api.calls['sendMessage']} /help replies sent for 1 accepted update")
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await bot.post_shutdown(application)
+    return failures
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("BOT_TOKEN", BOT_TOKEN)
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["BOT_MODE"] = "webhook"
+    os.environ["WEBHOOK_URL"] = "https://bot.example.com"
+    os.environ["WEBHOOK_LISTEN"] = "127.0.0.1"
+    os.environ["WEBHOOK_PORT"] = str(args.port)
+    os.environ.setdefault("WEBHOOK_PATH", "telegram")
+    os.environ.setdefault("WEBHOOK_SECRET", "webhook-check-secret")
+    failures = asyncio.run(run())
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,87 +1,201 @@
-import logging
-import signal
-import sys
-from telegram.ext import (
-    Application, 
-    CommandHandler, 
-    CallbackQueryHandler,
-    ConversationHandler,
-    MessageHandler,
-    filters
-)
-import config
-import handlers
-
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-def signal_handler(signum, frame):
-    """Handle shutdown signals gracefully"""
-    logger.info("Received shutdown signal. Cleaning up...")
-    sys.exit(0)
-
-async def error_handler(update, context):
-    """Log errors caused by Updates."""
-    logger.error(f"Update {update} caused error {context.error}")
-    if "Conflict" in str(context.error):
-        logger.error("Bot instance conflict detected. Please ensure only one instance is running.")
-        sys.exit(1)
-
-def main():
-    """Start the bot"""
-    # Set up signal handlers
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
-    try:
-        # Create the Application and pass it your bot's token
-        application = Application.builder().token(config.BOT_TOKEN).build()
-
-        # Register error handler
-        application.add_error_handler(error_handler)
-
-        # Add conversation handler for points management
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("a", handlers.admin_command)],
-            states={
-                handlers.CHOOSING_ACTION: [
-                    CallbackQueryHandler(handlers.button_callback)
-                ],
-                handlers.CHOOSING_USER: [
-                    CallbackQueryHandler(handlers.user_callback)
-                ],
-                handlers.ENTERING_POINTS: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.points_entered)
-                ]
-            },
-            fallbacks=[CommandHandler("cancel", handlers.cancel)],
-            per_chat=False,
-            name="admin_conversation"
-        )
-
-        # Add handlers
-        application.add_handler(conv_handler)
-        application.add_handler(CommandHandler("help", handlers.help_command))
-        application.add_handler(CommandHandler("top", handlers.show_top))
-        application.add_handler(CommandHandler("ac", handlers.clear_all_points))
-
-        # Add message handler to track users (outside of conversation)
-        application.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND,
-            handlers.handle_user_message
-        ))
-
-        # Start the bot
-        logger.info("Bot started successfully")
-        application.run_polling(drop_pending_updates=True)
-
-    except Exception as e:
-        logger.error(f"Critical error: {str(e)}")
-        sys.exit(1)
-
-if __name__ == '__main__':
-    main()
+import logging
+import secrets
+import sys
+from telegram import Update
+from telegram.error import Conflict
+from telegram.ext import (
+    Application, 
+    ChatMemberHandler,
+    CommandHandler, 
+    CallbackQueryHandler,
+    ConversationHandler,
+    MessageHandler,
+    filters
+)
+import config
+import database
+import handlers
+import logs
+import metrics
+from persistence import DatabasePersistence
+from scheduler import ChatOrderedUpdateProcessor, PendingUpdateQueue
+
+logger = logging.getLogger(__name__)
+
+metrics_server = metrics.MetricsServer(config.METRICS_HOST, config.METRICS_PORT)
+
+async def post_init(application):
+    """Connect to the database before the bot starts processing updates"""
+    await database.init_db()
+    handlers.db.ledger.start()
+    handlers.outbox.start(application.bot)
+    if config.METRICS_PORT:
+        await metrics_server.start()
+
+async def post_shutdown(application):
+    """Flush buffered writes once the bot has stopped processing updates"""
+    logger.info("Shutting down. Flushing buffered writes...")
+    await handlers.tracking_buffer.stop()
+    await handlers.db.ledger.stop()
+    await handlers.outbox.stop()
+    await metrics_server.stop()
+    await database.close_db()
+
+async def error_handler(update, context):
+    """Log errors caused by Updates."""
+    logger.error("Update %s caused error %s", update, context.error)
+    if isinstance(context.error, Conflict):
+        # Another process is polling with the same token. Worker processes never
+        # poll, so this is a second deployment; stop cleanly so buffers flush.
+        logger.error("Bot instance conflict detected. Please ensure only one instance is running.")
+        context.application.stop_running()
+
+def webhook_settings() -> dict:
+    """Arguments for starting the webhook server, shared with benchmarks/webhook_check.py"""
+    if not config.WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL must be set when BOT_MODE is 'webhook'")
+
+    # Telegram echoes the secret back in every request; the server rejects
+    # requests without it. A random one works too since setWebhook runs on each start.
+    secret_token = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    return {
+        "listen": config.WEBHOOK_LISTEN,
+        "port": config.WEBHOOK_PORT,
+        "url_path": config.WEBHOOK_PATH,
+        "webhook_url": f"{config.WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}",
+        "secret_token": secret_token,
+        "drop_pending_updates": config.DROP_PENDING_UPDATES,
+        "allowed_updates": Update.ALL_TYPES
+    }
+
+def run_webhook(application):
+    """Serve updates through a local HTTP server that Telegram POSTs to"""
+    application.run_webhook(**webhook_settings())
+
+def receive_updates(application):
+    """Run the application with long polling or a webhook until stopped"""
+    logger.info("Bot started successfully in %s mode", config.BOT_MODE)
+    if config.BOT_MODE == "webhook":
+        run_webhook(application)
+    else:
+        # chat_member updates are only sent when asked for explicitly
+        application.run_polling(
+            drop_pending_updates=config.DROP_PENDING_UPDATES,
+            allowed_updates=Update.ALL_TYPES
+        )
+
+def build_application(request=None, update_processor=None, owns_chat=None, updater=True):
+    """Create the Application with all handlers registered.
+
+    ``request`` replaces the HTTP client used for Bot API calls and
+    ``update_processor`` the concurrent update processor; both are meant for
+    running the bot against a local stand-in for Telegram. Worker processes
+    pass ``owns_chat`` to load only their own chats' persisted state and
+    ``updater=False`` because updates reach them from the front process.
+    """
+    # Create the Application and pass it your bot's token
+    builder = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Admin conversations and their user_data survive restarts
+        .persistence(DatabasePersistence(
+            handlers.db, config.PERSISTENCE_INTERVAL, owns_chat=owns_chat
+        ))
+        .concurrent_updates(update_processor or ChatOrderedUpdateProcessor(
+            config.MAX_CONCURRENT_UPDATES,
+            config.MAX_PENDING_UPDATES
+        ))
+        # Stops taking updates while MAX_PENDING_UPDATES are waiting or running
+        .update_queue(PendingUpdateQueue(config.MAX_PENDING_UPDATES))
+    )
+    if config.BOT_API_URL:
+        builder = builder.base_url(config.BOT_API_URL)
+    if request is not None:
+        builder = builder.request(request)
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Register error handler
+    application.add_error_handler(error_handler)
+
+    # Add conversation handler for points management
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("a", handlers.admin_command)],
+        states={
+            handlers.CHOOSING_ACTION: [
+                CallbackQueryHandler(handlers.button_callback)
+            ],
+            handlers.CHOOSING_USER: [
+                CallbackQueryHandler(handlers.user_callback, pattern=r'^user_'),
+                CallbackQueryHandler(handlers.page_callback, pattern=r'^pg:'),
+                CallbackQueryHandler(handlers.search_callback, pattern=r'^search$'),
+                CallbackQueryHandler(handlers.button_callback, pattern=r'^finish$')
+            ],
+            handlers.SEARCHING_USER: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.search_entered)
+            ],
+            handlers.ENTERING_POINTS: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.points_entered)
+            ]
+        },
+        fallbacks=[CommandHandler("cancel", handlers.cancel)],
+        # A worker only sees its own chats, so there a flow can't leave its chat
+        # anyway; keying it by chat keeps workers off each other's stored state
+        per_chat=owns_chat is not None,
+        name="admin_conversation",
+        persistent=True
+    )
+
+    # Add handlers
+    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("help", handlers.help_command))
+    application.add_handler(CommandHandler("top", handlers.show_top))
+    application.add_handler(CommandHandler(["rank", "me"], handlers.show_rank))
+    application.add_handler(CommandHandler("lasttop", handlers.show_last_top))
+    application.add_handler(CommandHandler("ac", handlers.clear_all_points))
+    application.add_handler(CommandHandler("ab", handlers.bulk_points))
+    application.add_handler(CommandHandler("export", handlers.export_points))
+    application.add_handler(CommandHandler("import", handlers.import_points))
+    application.add_handler(CommandHandler("aa", handlers.add_chat_admin))
+    application.add_handler(CommandHandler("ar", handlers.remove_chat_admin))
+
+    # chat_member updates keep the cached admin lists in step with Telegram
+    application.add_handler(ChatMemberHandler(
+        handlers.chat_member_updated,
+        ChatMemberHandler.ANY_CHAT_MEMBER
+    ))
+
+    # Add message handler to track users (outside of conversation)
+    application.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND,
+        handlers.handle_user_message
+    ))
+
+    # Time every handler for the /metrics endpoint
+    metrics.instrument_application(application)
+
+    return application
+
+def main():
+    """Start the bot"""
+    logs.setup()
+    try:
+        if config.WORKERS > 1:
+            # Imported here: worker processes import this module themselves
+            import workers
+            application = workers.build_front_application(error_handler)
+        else:
+            application = build_application()
+
+        # Start the bot; both modes stop it cleanly on SIGINT/SIGTERM
+        receive_updates(application)
+
+    except Exception as e:
+        logger.error("Critical error: %s", e)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
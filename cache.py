@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+class TTLCache:
+    """Bounded in-memory cache with LRU eviction and per-entry expiry"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return a cached value and mark it as recently used"""
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entry when full"""
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove a key from the cache"""
+        entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def discard_where(self, predicate):
+        """Remove every key for which ``predicate(key)`` is true"""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self):
+        """Drop all cached entries"""
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and the current size"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+class DelayedFlush:
+    """Runs an async ``flush`` callback shortly after work is queued.
+
+    ``schedule(delay)`` arranges a flush at most ``delay`` seconds from now;
+    while one is pending, later calls can only bring it forward, so a burst
+    of queued work is written in one go. Flush tasks are kept until they
+    finish so ``wait`` can drain them on shutdown.
+    """
+
+    def __init__(self, flush):
+        self.flush = flush
+        self._handle = None
+        self._tasks = set()
+
+    def schedule(self, delay: float):
+        """Flush within ``delay`` seconds"""
+        loop = asyncio.get_running_loop()
+        if self._handle is not None:
+            if self._handle.when() <= loop.time() + delay:
+                return
+            self._handle.cancel()
+        self._handle = loop.call_later(delay, self._start)
+
+    def cancel(self):
+        """Drop the pending flush, e.g. because it is running right now"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _start(self):
+        self._handle = None
+        task = asyncio.create_task(self.flush())
+        # Keep a reference so the task isn't garbage collected mid-flight
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def wait(self):
+        """Wait for the flushes already started"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -1,21 +1,110 @@
-import os
-
-# Telegram bot configuration
-BOT_TOKEN = os.environ.get("BOT_TOKEN")  # Отримайте токен у @BotFather
-ADMIN_USER_ID = int(os.environ.get("ADMIN_USER_ID", 0))  # ID адміністратора, отриманий через @userinfobot
-
-# Messages
-HELP_MESSAGE = """
-Доступні команди:
-/help - Показати це повідомлення
-/top - Показати рейтинг по балам
-
-Команди адміністратора:
-/a - Меню адміністратора
-/ac - Очистити всі бали у всіх користувачів
-"""
-
-NOT_ADMIN_MESSAGE = "Вибачте, ця команда доступна тільки для адміністраторів."
-INVALID_FORMAT_MESSAGE = "Неправильний формат команди. Використовуйте: /команда @username кількість_балів"
-USER_NOT_FOUND_MESSAGE = "Користувача не знайдено."
-POINTS_UPDATED_MESSAGE = "Бали успішно оновлено."
+import os
+
+# Telegram bot configuration
+BOT_TOKEN = os.environ.get("BOT_TOKEN")  # Отримайте токен у @BotFather
+ADMIN_USER_ID = int(os.environ.get("ADMIN_USER_ID", 0))  # ID власника бота (адміністратор у всіх чатах), отриманий через @userinfobot
+
+# Update delivery: "polling" (getUpdates) or "webhook" (local HTTP server)
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+BOT_API_URL = os.environ.get("BOT_API_URL")  # Інша адреса Bot API, наприклад локальний тестовий сервер
+DROP_PENDING_UPDATES = os.environ.get("DROP_PENDING_UPDATES", "false").lower() == "true"  # Пропускати оновлення, що накопичились під час простою
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # Публічна адреса, на яку Telegram надсилатиме оновлення
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # Значення заголовка X-Telegram-Bot-Api-Secret-Token
+
+# Worker processes: 1 runs everything in one process; more starts a front
+# process that receives updates and hands each chat to one worker
+WORKERS = int(os.environ.get("WORKERS", 1))  # Кількість процесів-обробників
+
+# Concurrent update processing, ordered per chat and per user
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 32))  # Скільки оновлень обробляються одночасно
+MAX_PENDING_UPDATES = int(os.environ.get("MAX_PENDING_UPDATES", 4096))  # Скільки оновлень можуть чекати своєї черги
+
+# Database startup
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))  # Розмір пулу з'єднань, ділиться між усіма процесами-обробниками
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))  # Додаткові з'єднання понад пул, теж на всі процеси разом
+DB_CONNECT_RETRIES = int(os.environ.get("DB_CONNECT_RETRIES", 5))  # Скільки разів пробувати підключитися до бази під час запуску
+DB_CONNECT_DELAY = float(os.environ.get("DB_CONNECT_DELAY", 1))  # Початкова пауза між спробами, секунди (подвоюється)
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", 5))  # Скільки секунд SQLite чекає, поки інший процес закінчить запис
+
+# Outgoing Bot API calls
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", 30))  # Максимум викликів Bot API за секунду для всього бота (на всі процеси разом)
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", 1))  # Максимум повідомлень за секунду в одному чаті
+OUTBOX_CHAT_BURST = float(os.environ.get("OUTBOX_CHAT_BURST", 5))  # Скільки повідомлень у чат можна надіслати одразу
+OUTBOX_DELETE_LINGER = float(os.environ.get("OUTBOX_DELETE_LINGER", 0.5))  # Скільки секунд збирати видалення в один запит
+OUTBOX_MAX_RETRIES = int(os.environ.get("OUTBOX_MAX_RETRIES", 3))  # Скільки разів повторювати запит після flood control
+
+# Logging
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()  # DEBUG, INFO, WARNING або ERROR; дії адміністраторів пишуться завжди
+LOG_EVENT_RATE = float(os.environ.get("LOG_EVENT_RATE", 5))  # Скільки частих записів одного типу (нові учасники, повільні запити) пишеться за секунду
+
+# Metrics and instrumentation
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # Порт для /metrics у форматі Prometheus, 0 - вимкнено
+SLOW_QUERY_THRESHOLD = float(os.environ.get("SLOW_QUERY_THRESHOLD", 0.5))  # Запити, довші за цю кількість секунд, потрапляють у лог
+
+# Known-member cache used to skip redundant tracking writes
+MEMBER_CACHE_SIZE = int(os.environ.get("MEMBER_CACHE_SIZE", 50000))  # Максимальна кількість (чат, користувач) у кеші
+MEMBER_CACHE_TTL = int(os.environ.get("MEMBER_CACHE_TTL", 3600))  # Час життя запису в секундах
+
+# Write-behind batching of member-tracking upserts
+TRACKING_BATCH_SIZE = int(os.environ.get("TRACKING_BATCH_SIZE", 500))  # Кількість записів, після якої буфер скидається
+TRACKING_FLUSH_INTERVAL = float(os.environ.get("TRACKING_FLUSH_INTERVAL", 1.0))  # Максимальна затримка запису в секундах
+TRACKING_MAX_PENDING = int(os.environ.get("TRACKING_MAX_PENDING", 10000))  # Скільки записів тримати, поки база недоступна
+
+# Point ledger
+LEDGER_BATCH_SIZE = int(os.environ.get("LEDGER_BATCH_SIZE", 200))  # Максимальна кількість подій в одній транзакції
+LEDGER_LINGER = float(os.environ.get("LEDGER_LINGER", 0.005))  # Скільки секунд чекати на інші зміни перед записом
+LEDGER_RETENTION_DAYS = int(os.environ.get("LEDGER_RETENTION_DAYS", 90))  # Скільки днів зберігати окремі події
+LEDGER_COMPACT_INTERVAL = float(os.environ.get("LEDGER_COMPACT_INTERVAL", 3600))  # Як часто стискати старі події, секунди
+
+# Seasons
+SEASON_CACHE_SIZE = int(os.environ.get("SEASON_CACHE_SIZE", 100000))  # Максимальна кількість чатів з відомим поточним сезоном
+SEASON_CACHE_TTL = float(os.environ.get("SEASON_CACHE_TTL", 3600))  # Час життя запису в секундах
+
+# Per-chat admins: Telegram administrators plus the allow-list in the database
+ADMIN_CACHE_REFRESH = float(os.environ.get("ADMIN_CACHE_REFRESH", 300))  # Через скільки секунд оновлювати список адміністраторів у фоні
+ADMIN_CACHE_TTL = float(os.environ.get("ADMIN_CACHE_TTL", 3600))  # Після скількох секунд список більше не використовується
+ADMIN_CACHE_SIZE = int(os.environ.get("ADMIN_CACHE_SIZE", 10000))  # Максимальна кількість чатів у кеші
+
+# Conversation persistence
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", 5))  # Як часто зберігати стан меню адміністратора в базу, секунди
+
+# Admin user picker
+USER_PAGE_SIZE = int(os.environ.get("USER_PAGE_SIZE", 20))  # Кількість користувачів на одній сторінці меню
+
+# Messages
+HELP_MESSAGE = """
+Доступні команди:
+/help - Показати це повідомлення
+/top - Показати рейтинг по балам
+/rank або /me - Показати свої бали та місце в рейтингу
+/lasttop - Показати рейтинг минулого сезону
+
+Команди адміністратора:
+/a - Меню адміністратора
+/ac - Почати новий сезон: обнулити бали всіх користувачів
+/ab - Нарахувати бали багатьом користувачам одним повідомленням
+/export [csv|json] - Вивантажити бали чату у файл
+/import - Завантажити бали з файлу (відповіддю на повідомлення з файлом)
+
+Адміністратори чату:
+/aa @username - Дозволити користувачу керувати балами в цьому чаті
+/ar @username - Забрати цей дозвіл
+"""
+
+NOT_ADMIN_MESSAGE = "Вибачте, ця команда доступна тільки для адміністраторів."
+INVALID_FORMAT_MESSAGE = "Неправильний формат команди. Використовуйте: /команда @username кількість_балів"
+USER_NOT_FOUND_MESSAGE = "Користувача не знайдено."
+POINTS_UPDATED_MESSAGE = "Бали успішно оновлено."
+EXPORT_USAGE_MESSAGE = "Використання: /export csv або /export json"
+IMPORT_USAGE_MESSAGE = """Надішліть файл CSV або JSON зі стовпцями user_id, username, points і відповідайте на нього командою /import.
+Бали вказаних користувачів буде встановлено рівними значенням з файлу."""
+CHAT_ADMIN_USAGE_MESSAGE = "Використання: /aa @username або /ar @username (можна також відповісти командою на повідомлення користувача)."
+BULK_USAGE_MESSAGE = """Використання: /ab @username +кількість_балів ...
+Можна вказати кілька пар в одному рядку або по одній на рядок, наприклад:
+/ab @alice +10 @bob -5
+@carol 3
+Також можна відповісти командою /ab на повідомлення зі списком."""
@@ -1,197 +1,881 @@
-import os
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from contextlib import contextmanager
-import logging
-from sqlalchemy.exc import OperationalError
-from time import sleep
-
-# Configure logging with less verbose output
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.WARNING
-)
-logger = logging.getLogger(__name__)
-
-# Get database URL from environment
-DATABASE_URL = os.environ.get("DATABASE_URL")
-if DATABASE_URL is None:
-    raise Exception("DATABASE_URL environment variable is not set")
-
-def create_db_engine(retries=3, delay=1):
-    """Create database engine with optimized connection pool"""
-    for attempt in range(retries):
-        try:
-            engine = create_engine(
-                DATABASE_URL,
-                pool_size=10,
-                max_overflow=20,
-                pool_timeout=30,
-                pool_recycle=1800,
-                pool_pre_ping=True,
-                connect_args={
-                    'connect_timeout': 10,
-                    'application_name': 'TelegramPointsBot',
-                    'sslmode': 'require'
-                }
-            )
-
-            # Test the connection
-            with engine.connect() as connection:
-                connection.execute(text("SELECT 1"))
-            return engine
-
-        except OperationalError as e:
-            if attempt == retries - 1:
-                logger.error(f"Failed to connect to database after {retries} attempts")
-                raise
-            sleep(delay)
-            delay *= 2
-
-engine = create_db_engine()
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-class UserPoints(Base):
-    __tablename__ = "user_points"
-
-    id = Column(Integer, primary_key=True, index=True)
-    chat_id = Column(BigInteger, index=True)
-    user_id = Column(BigInteger, index=True)
-    username = Column(String)
-    points = Column(Integer, default=0)
-
-# Create tables only if they don't exist
-Base.metadata.create_all(bind=engine, checkfirst=True)
-
-@contextmanager
-def get_db():
-    """Provide a transactional scope around a series of operations."""
-    db = SessionLocal()
-    try:
-        yield db
-        db.commit()
-    except Exception as e:
-        logger.error(f"Database transaction failed: {e}")
-        db.rollback()
-        raise
-    finally:
-        db.close()
-
-class Database:
-    def __init__(self):
-        """Initialize database connection"""
-        Base.metadata.create_all(bind=engine, checkfirst=True)
-
-    def clear_all_points(self, chat_id: int):
-        """Clear all points from the specific chat"""
-        with get_db() as db:
-            db.query(UserPoints).filter(UserPoints.chat_id == chat_id).update({"points": 0})
-
-    def get_user_id_by_username(self, chat_id: int, username: str) -> int:
-        """Get user_id by username for specific chat"""
-        with get_db() as db:
-            user = db.query(UserPoints.user_id).filter(
-                UserPoints.chat_id == chat_id,
-                UserPoints.username == username
-            ).first()
-            return user.user_id if user else None
-
-    def get_all_users(self, chat_id: int) -> list:
-        """Get list of all usernames in specific chat"""
-        with get_db() as db:
-            users = db.query(UserPoints.username).filter(
-                UserPoints.chat_id == chat_id,
-                UserPoints.username.isnot(None)
-            ).all()
-            return [user.username for user in users]
-
-    def add_points(self, chat_id: int, user_id: int, points: int, username: str = None) -> bool:
-        """Add points to a user in specific chat"""
-        try:
-            with get_db() as db:
-                user = db.query(UserPoints).filter(
-                    UserPoints.chat_id == chat_id,
-                    UserPoints.user_id == user_id
-                ).first()
-
-                if not user:
-                    user = UserPoints(
-                        chat_id=chat_id,
-                        user_id=user_id,
-                        points=points,
-                        username=username
-                    )
-                    db.add(user)
-                else:
-                    if username and user.username != username:
-                        user.username = username
-                    user.points += points
-
-                return True
-        except Exception as e:
-            logger.error(f"Error in add_points: {e}")
-            return False
-
-    def subtract_points(self, chat_id: int, user_id: int, points: int, username: str = None) -> bool:
-        """Subtract points from a user in specific chat"""
-        try:
-            with get_db() as db:
-                user = db.query(UserPoints).filter(
-                    UserPoints.chat_id == chat_id,
-                    UserPoints.user_id == user_id
-                ).first()
-
-                if not user:
-                    user = UserPoints(
-                        chat_id=chat_id,
-                        user_id=user_id,
-                        points=0,
-                        username=username
-                    )
-                    db.add(user)
-
-                if username and user.username != username:
-                    user.username = username
-                user.points -= points
-
-                return True
-        except Exception as e:
-            logger.error(f"Error in subtract_points: {e}")
-            return False
-
-    def get_user_points(self, chat_id: int, user_id: int) -> int:
-        """Get points for a specific user in specific chat"""
-        try:
-            with get_db() as db:
-                points = db.query(UserPoints.points).filter(
-                    UserPoints.chat_id == chat_id,
-                    UserPoints.user_id == user_id
-                ).scalar()
-                return points or 0
-        except Exception as e:
-            logger.error(f"Error in get_user_points: {e}")
-            return 0
-
-    def get_top_users(self, chat_id: int, limit: int = 10) -> list:
-        """Get top users by points in specific chat"""
-        try:
-            with get_db() as db:
-                users = db.query(
-                    UserPoints.user_id,
-                    UserPoints.points,
-                    UserPoints.username
-                ).filter(
-                    UserPoints.chat_id == chat_id
-                ).order_by(
-                    UserPoints.points.desc()
-                ).limit(limit).all()
-
-                return [(user.user_id, {
-                    "points": user.points,
-                    "username": user.username
-                }) for user in users]
-        except Exception as e:
-            logger.error(f"Error in get_top_users: {e}")
-            return []
+import os
+import asyncio
+from sqlalchemy import (
+    Column, Integer, String, BigInteger, DateTime, Index, JSON, text, select, delete, func,
+    tuple_, literal, exists
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import aliased
+from contextlib import asynccontextmanager
+from itertools import islice
+import logging
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+import config
+import metrics
+from cache import TTLCache
+from leaderboard import LeaderboardCache
+from ledger import PointLedger
+import migrations
+
+logger = logging.getLogger(__name__)
+
+# Postgres advisory lock key that lets one worker at a time compact the ledger
+COMPACTION_LOCK_ID = 7_340_116
+
+def build_async_url(database_url: str):
+    """Convert a plain Postgres or SQLite URL into an asyncpg or aiosqlite URL.
+
+    Returns the URL and the SSL mode, which asyncpg takes as a connect
+    argument instead of the libpq ``sslmode`` query parameter (None for
+    SQLite).
+    """
+    url = make_url(database_url)
+    if url.drivername in ("postgres", "postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+asyncpg")
+    elif url.drivername in ("sqlite", "sqlite+pysqlite"):
+        url = url.set(drivername="sqlite+aiosqlite")
+    if url.get_backend_name() == "sqlite":
+        return url, None
+    query = dict(url.query)
+    ssl_mode = query.pop("sslmode", "require")
+    return url.set(query=query), ssl_mode
+
+# Set on every SQLite connection. WAL lets readers work while a write
+# commits; with synchronous=NORMAL a commit doesn't wait for fsync, and
+# only a power loss can undo the last commits, never corrupt the file.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+)
+
+def _sqlite_connect(readonly: bool):
+    def on_connect(dbapi_connection, connection_record):
+        # Turn off the driver's own transaction handling; the begin
+        # listeners below emit BEGIN themselves
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.execute(f"PRAGMA busy_timeout={int(config.SQLITE_BUSY_TIMEOUT * 1000)}")
+        if readonly:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+    return on_connect
+
+def _begin_immediate(connection):
+    # Take the write lock up front, so a transaction that reads before it
+    # writes waits for other processes instead of failing on the upgrade
+    connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+def _begin_deferred(connection):
+    connection.exec_driver_sql("BEGIN")
+
+def create_sqlite_engines(url, workers: int) -> tuple:
+    """Create the SQLite writer engine and the pooled reader engine"""
+    # SQLite has one writer at a time: a single connection queues writes in
+    # the pool instead of failing them with "database is locked"
+    writer = create_async_engine(
+        url, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0, pool_timeout=30
+    )
+    event.listen(writer.sync_engine, "connect", _sqlite_connect(readonly=False))
+    event.listen(writer.sync_engine, "begin", _begin_immediate)
+    if url.database in (None, "", ":memory:"):
+        # Each connection to an in-memory database would get its own, empty one
+        return writer, writer
+
+    reader = create_async_engine(
+        url,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=max(config.DB_POOL_SIZE // workers, 1),
+        max_overflow=config.DB_MAX_OVERFLOW // workers,
+        pool_timeout=30
+    )
+    event.listen(reader.sync_engine, "connect", _sqlite_connect(readonly=True))
+    event.listen(reader.sync_engine, "begin", _begin_deferred)
+    return writer, reader
+
+def create_db_engines() -> tuple:
+    """Create the async engines for writes and for reads.
+
+    On Postgres both are the same engine with an optimized connection pool.
+    """
+    # Read when the bot starts rather than at import time
+    database_url = os.environ.get("DATABASE_URL")
+    if database_url is None:
+        raise Exception("DATABASE_URL environment variable is not set")
+
+    url, ssl_mode = build_async_url(database_url)
+    # The connection budget is shared by all worker processes
+    workers = max(config.WORKERS, 1)
+    if url.get_backend_name() == "sqlite":
+        return create_sqlite_engines(url, workers)
+
+    new_engine = create_async_engine(
+        url,
+        pool_size=max(config.DB_POOL_SIZE // workers, 1),
+        max_overflow=config.DB_MAX_OVERFLOW // workers,
+        pool_timeout=30,
+        pool_recycle=1800,
+        pool_pre_ping=True,
+        connect_args={
+            'timeout': 10,
+            'ssl': ssl_mode,
+            'server_settings': {'application_name': 'TelegramPointsBot'}
+        }
+    )
+    return new_engine, new_engine
+
+# Created by init_db() when the bot starts and disposed by close_db().
+# read_engine is engine itself except on SQLite.
+engine = None
+read_engine = None
+SessionLocal = None
+ReadSessionLocal = None
+
+def insert(table):
+    """INSERT with the ON CONFLICT support of the database in use"""
+    if engine is not None and engine.dialect.name == "sqlite":
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    metrics.DB_QUERY_LATENCY.observe(elapsed)
+    if elapsed >= config.SLOW_QUERY_THRESHOLD:
+        metrics.DB_SLOW_QUERIES.inc()
+        logger.warning("Slow query (%.0f ms): %s", elapsed * 1000, ' '.join(statement.split())[:500],
+                       extra={"event": "slow_query"})
+
+def _drop_query_timer(exception_context):
+    # after_cursor_execute doesn't run for failed statements
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_started"):
+        connection.info["query_started"].pop()
+
+def _instrument_engine(engine):
+    event.listen(engine.sync_engine, "before_cursor_execute", _start_query_timer)
+    event.listen(engine.sync_engine, "after_cursor_execute", _stop_query_timer)
+    event.listen(engine.sync_engine, "handle_error", _drop_query_timer)
+
+def _pool_stat(read):
+    # No samples until the engine exists
+    return read(engine.pool) if engine is not None else {}
+
+metrics.Gauge("bot_db_pool_size", "Configured size of the connection pool",
+              lambda: _pool_stat(lambda pool: pool.size()))
+metrics.Gauge("bot_db_pool_checked_out", "Connections currently checked out of the pool",
+              lambda: _pool_stat(lambda pool: pool.checkedout()))
+metrics.Gauge("bot_db_pool_overflow", "Connections open beyond the pool size",
+              lambda: _pool_stat(lambda pool: max(pool.overflow(), 0)))
+
+Base = declarative_base()
+
+class UserPoints(Base):
+    __tablename__ = "user_points"
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(BigInteger)
+    user_id = Column(BigInteger, index=True)
+    username = Column(String)
+    points = Column(Integer, default=0)
+    # Points are kept per season; rows of past seasons are left as they were
+    season = Column(Integer, nullable=False, default=0)
+
+    # Schema changes are applied by migrations.py; keep these in step with it.
+    # The lower(username) prefix index only exists there.
+    __table_args__ = (
+        # Conflict target for the tracking and point upserts
+        Index("uq_user_points_chat_season_user", "chat_id", "season", "user_id", unique=True),
+        Index("ix_user_points_chat_season_points", "chat_id", "season", points.desc(), "user_id"),
+        Index("ix_user_points_chat_username", "chat_id", "username"),
+        Index("ix_user_points_chat_user_season", "chat_id", "user_id", "season"),
+    )
+
+class PointEvent(Base):
+    """Append-only ledger of point changes"""
+    __tablename__ = "point_events"
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    user_id = Column(BigInteger, nullable=False)
+    delta = Column(Integer, nullable=False)
+    actor_id = Column(BigInteger)
+    season = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_point_events_chat_user", "chat_id", "user_id", "id"),
+        Index("ix_point_events_created_at", "created_at"),
+    )
+
+class PointSnapshot(Base):
+    """Sum of the ledger events that compaction has rolled up"""
+    __tablename__ = "point_snapshots"
+
+    chat_id = Column(BigInteger, primary_key=True)
+    season = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    points = Column(Integer, nullable=False)
+    as_of = Column(DateTime(timezone=True), nullable=False)
+
+class ChatSeason(Base):
+    """Current season of a chat; chats without a row are in season 0"""
+    __tablename__ = "chat_seasons"
+
+    chat_id = Column(BigInteger, primary_key=True)
+    season = Column(Integer, nullable=False)
+    started_by = Column(BigInteger)
+    started_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class ChatAdmin(Base):
+    """User allowed to manage points in a chat without being a Telegram admin there"""
+    __tablename__ = "chat_admins"
+
+    chat_id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    added_by = Column(BigInteger)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class ConversationState(Base):
+    """Persisted state of one ConversationHandler conversation"""
+    __tablename__ = "conversation_states"
+
+    name = Column(String, primary_key=True)
+    # JSON list of the conversation key, e.g. "[123456]"
+    key = Column(String, primary_key=True)
+    state = Column(JSON, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class StoredUserData(Base):
+    """Persisted context.user_data of one user, keyed by the chat of its admin flow"""
+    __tablename__ = "user_data"
+
+    user_id = Column(BigInteger, primary_key=True)
+    # user_data["chat_id"], or 0 if it has none
+    chat_id = Column(BigInteger, primary_key=True)
+    data = Column(JSON, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+async def init_db(retries=None, delay=None):
+    """Create the engine, wait for the database and bring the schema up to date.
+
+    Called once from the Application's post_init hook; connection failures
+    are retried with exponential backoff without blocking the event loop.
+    """
+    global engine, read_engine, SessionLocal, ReadSessionLocal
+    if engine is not None:
+        return
+
+    retries = retries or config.DB_CONNECT_RETRIES
+    delay = delay or config.DB_CONNECT_DELAY
+    new_engine, new_read_engine = create_db_engines()
+    _instrument_engine(new_engine)
+    if new_read_engine is not new_engine:
+        _instrument_engine(new_read_engine)
+    try:
+        for attempt in range(retries):
+            try:
+                async with new_engine.connect() as connection:
+                    await connection.execute(text("SELECT 1"))
+                break
+            except (OperationalError, OSError) as e:
+                if attempt == retries - 1:
+                    logger.error("Failed to connect to database after %s attempts", retries)
+                    raise
+                logger.warning("Database connection attempt %s failed: %s", attempt + 1, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+        version = await migrations.migrate(new_engine)
+        logger.info("Database schema is at version %s", version)
+    except Exception:
+        await new_engine.dispose()
+        await new_read_engine.dispose()
+        raise
+
+    engine = new_engine
+    read_engine = new_read_engine
+    SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    ReadSessionLocal = async_sessionmaker(
+        read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+    )
+
+async def close_db():
+    """Close every pooled connection; init_db() can be called again afterwards"""
+    global engine, read_engine, SessionLocal, ReadSessionLocal
+    if engine is not None:
+        await engine.dispose()
+        await read_engine.dispose()
+        engine = None
+        read_engine = None
+        SessionLocal = None
+        ReadSessionLocal = None
+
+@asynccontextmanager
+async def get_db(readonly: bool = False):
+    """Provide an async transactional scope around a series of operations.
+
+    ``readonly`` scopes may use a reader connection; on SQLite that keeps
+    them off the single writer connection.
+    """
+    if SessionLocal is None:
+        raise RuntimeError("Database is not initialized, call init_db() first")
+    async with (ReadSessionLocal if readonly else SessionLocal)() as db:
+        try:
+            yield db
+            await db.commit()
+        except Exception as e:
+            if isinstance(e, PoolTimeoutError):
+                metrics.DB_POOL_TIMEOUTS.inc()
+            logger.error("Database transaction failed: %s", e)
+            await db.rollback()
+            raise
+
+class Database:
+    def __init__(self):
+        """Initialize the in-memory leaderboard and the point ledger writer"""
+        self.leaderboard = LeaderboardCache()
+        self.ledger = PointLedger(
+            self,
+            config.LEDGER_BATCH_SIZE,
+            config.LEDGER_LINGER,
+            config.LEDGER_RETENTION_DAYS,
+            config.LEDGER_COMPACT_INTERVAL
+        )
+        # chat_id -> current season; a chat's season only changes in the
+        # process that owns the chat, through clear_all_points
+        self.seasons = TTLCache(config.SEASON_CACHE_SIZE, config.SEASON_CACHE_TTL)
+
+    async def current_seasons(self, chat_ids) -> dict:
+        """Get the current season of every chat, loading the uncached ones with one query"""
+        seasons = {}
+        missing = set()
+        for chat_id in chat_ids:
+            season = self.seasons.get(chat_id)
+            if season is None:
+                missing.add(chat_id)
+            else:
+                seasons[chat_id] = season
+        if missing:
+            async with get_db(readonly=True) as db:
+                result = await db.execute(
+                    select(ChatSeason.chat_id, ChatSeason.season).where(
+                        ChatSeason.chat_id.in_(missing)
+                    )
+                )
+                loaded = dict(result.all())
+            for chat_id in missing:
+                seasons[chat_id] = loaded.get(chat_id, 0)
+                self.seasons.set(chat_id, seasons[chat_id])
+        return seasons
+
+    async def current_season(self, chat_id: int) -> int:
+        """Get the current season of specific chat"""
+        return (await self.current_seasons([chat_id]))[chat_id]
+
+    async def clear_all_points(self, chat_id: int, actor_id: int = None) -> int:
+        """Start a new season in the specific chat and return its number.
+
+        Only the chat's season counter is written: balances start from zero
+        in the new season, and the rows of earlier ones stay as they were.
+        """
+        stmt = insert(ChatSeason).values(chat_id=chat_id, season=1, started_by=actor_id)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ChatSeason.chat_id],
+            set_={
+                "season": ChatSeason.season + 1,
+                "started_by": stmt.excluded.started_by,
+                "started_at": func.now()
+            }
+        ).returning(ChatSeason.season)
+        async with get_db() as db:
+            season = (await db.execute(stmt)).scalar()
+        self.seasons.set(chat_id, season)
+        self.leaderboard.reset(chat_id)
+        return season
+
+    async def get_user_id_by_username(self, chat_id: int, username: str) -> int:
+        """Get user_id by username for specific chat"""
+        async with get_db(readonly=True) as db:
+            # Members are looked up across seasons, the latest row first
+            result = await db.execute(
+                select(UserPoints.user_id).where(
+                    UserPoints.chat_id == chat_id,
+                    UserPoints.username == username
+                ).order_by(UserPoints.season.desc()).limit(1)
+            )
+            return result.scalar()
+
+    async def get_chat_admin_ids(self, chat_id: int) -> set:
+        """Get the allow-listed admins of specific chat"""
+        async with get_db(readonly=True) as db:
+            result = await db.execute(
+                select(ChatAdmin.user_id).where(ChatAdmin.chat_id == chat_id)
+            )
+            return set(result.scalars())
+
+    async def add_chat_admin(self, chat_id: int, user_id: int, actor_id: int = None) -> bool:
+        """Allow-list a user as admin of specific chat; False if already there"""
+        async with get_db() as db:
+            result = await db.execute(
+                insert(ChatAdmin).values(
+                    chat_id=chat_id, user_id=user_id, added_by=actor_id
+                ).on_conflict_do_nothing().returning(ChatAdmin.user_id)
+            )
+            return result.scalar() is not None
+
+    async def remove_chat_admin(self, chat_id: int, user_id: int) -> bool:
+        """Remove a user from the chat's admin allow-list; False if not there"""
+        async with get_db() as db:
+            result = await db.execute(
+                delete(ChatAdmin).where(
+                    ChatAdmin.chat_id == chat_id,
+                    ChatAdmin.user_id == user_id
+                )
+            )
+            return result.rowcount > 0
+
+    async def load_user_data(self) -> dict:
+        """Get every persisted user_data dict by (user_id, chat_id), oldest first"""
+        async with get_db(readonly=True) as db:
+            result = await db.execute(
+                select(StoredUserData.user_id, StoredUserData.chat_id, StoredUserData.data)
+                .order_by(StoredUserData.updated_at)
+            )
+            return {(user_id, chat_id): data for user_id, chat_id, data in result}
+
+    async def load_conversations(self, name: str) -> dict:
+        """Get the persisted states of a ConversationHandler by JSON key"""
+        async with get_db(readonly=True) as db:
+            result = await db.execute(
+                select(ConversationState.key, ConversationState.state).where(
+                    ConversationState.name == name
+                )
+            )
+            return {key: state for key, state in result}
+
+    async def save_persistence(self, user_data: dict, conversations: dict):
+        """Write changed user_data and conversation states in one transaction.
+
+        ``user_data`` maps (user_id, chat_id) to the new dict and
+        ``conversations`` maps (name, key) to the new state; None deletes the row.
+        """
+        async with get_db() as db:
+            stored = [
+                {"user_id": user_id, "chat_id": chat_id, "data": data}
+                for (user_id, chat_id), data in sorted(user_data.items()) if data is not None
+            ]
+            if stored:
+                statement = insert(StoredUserData).values(stored)
+                await db.execute(statement.on_conflict_do_update(
+                    index_elements=[StoredUserData.user_id, StoredUserData.chat_id],
+                    set_={"data": statement.excluded.data, "updated_at": func.now()}
+                ))
+            dropped = [key for key, data in user_data.items() if data is None]
+            if dropped:
+                await db.execute(delete(StoredUserData).where(
+                    tuple_(StoredUserData.user_id, StoredUserData.chat_id).in_(dropped)
+                ))
+
+            states = [
+                {"name": name, "key": key, "state": state}
+                for (name, key), state in sorted(conversations.items()) if state is not None
+            ]
+            if states:
+                statement = insert(ConversationState).values(states)
+                await db.execute(statement.on_conflict_do_update(
+                    index_elements=[ConversationState.name, ConversationState.key],
+                    set_={"state": statement.excluded.state, "updated_at": func.now()}
+                ))
+            ended = [key for key, state in conversations.items() if state is None]
+            if ended:
+                await db.execute(delete(ConversationState).where(
+                    tuple_(ConversationState.name, ConversationState.key).in_(ended)
+                ))
+
+    async def resolve_usernames(self, chat_id: int, usernames: list) -> dict:
+        """Map many usernames in specific chat to (user_id, stored username), ignoring case"""
+        if not usernames:
+            return {}
+        requested = {username.lower(): username for username in usernames}
+        async with get_db(readonly=True) as db:
+            result = await db.execute(
+                select(UserPoints.username, UserPoints.user_id).where(
+                    UserPoints.chat_id == chat_id,
+                    func.lower(UserPoints.username).in_(requested)
+                ).order_by(UserPoints.season)
+            )
+            # Rows of the latest season come last and win
+            return {requested[row.username.lower()]: (row.user_id, row.username) for row in result}
+
+    async def upsert_members(self, rows: list):
+        """Insert or refresh tracked members with one multi-row upsert.
+
+        ``rows`` is a list of ``(chat_id, user_id, username)`` tuples with
+        unique (chat_id, user_id) pairs. Members get a row in the current
+        season of their chat.
+        """
+        if not rows:
+            return
+        seasons = await self.current_seasons({chat_id for chat_id, _, _ in rows})
+        stmt = insert(UserPoints).values([
+            {
+                "chat_id": chat_id,
+                "season": seasons[chat_id],
+                "user_id": user_id,
+                "username": username,
+                "points": 0
+            }
+            for chat_id, user_id, username in rows
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserPoints.chat_id, UserPoints.season, UserPoints.user_id],
+            set_={"username": stmt.excluded.username},
+            where=UserPoints.username.is_distinct_from(stmt.excluded.username)
+        )
+        async with get_db() as db:
+            await db.execute(stmt)
+        for chat_id, user_id, username in rows:
+            self.leaderboard.track(chat_id, user_id, username)
+
+    async def get_users_page(self, chat_id: int, cursor: tuple = None, backward: bool = False,
+                             prefix: str = None, limit: int = 20) -> tuple:
+        """Get one page of (username, user_id) pairs in a chat and whether more follow"""
+        # Each member under their username from the latest season that has one,
+        # so a member renamed since an earlier season isn't listed twice
+        newer = aliased(UserPoints)
+        stmt = select(UserPoints.username, UserPoints.user_id).where(
+            UserPoints.chat_id == chat_id,
+            UserPoints.username.isnot(None),
+            ~exists().where(
+                newer.chat_id == UserPoints.chat_id,
+                newer.user_id == UserPoints.user_id,
+                newer.season > UserPoints.season,
+                newer.username.isnot(None)
+            )
+        )
+        if prefix:
+            # Byte-wise range so the text_pattern_ops index serves the search;
+            # SQLite compares text byte-wise already
+            lowered = prefix.lower()
+            upper_bound = lowered[:-1] + chr(ord(lowered[-1]) + 1)
+            at_least, below = ("~>=~", "~<~") if engine.dialect.name == "postgresql" else (">=", "<")
+            stmt = stmt.where(
+                func.lower(UserPoints.username).op(at_least)(lowered),
+                func.lower(UserPoints.username).op(below)(upper_bound)
+            )
+
+        # Keyset pagination: ``cursor`` is the (username, user_id) pair bounding
+        # the page, and ``backward`` pages towards the start
+        key = tuple_(UserPoints.username, UserPoints.user_id)
+        if backward:
+            if cursor:
+                stmt = stmt.where(key < tuple_(*cursor))
+            stmt = stmt.order_by(UserPoints.username.desc(), UserPoints.user_id.desc())
+        else:
+            if cursor:
+                stmt = stmt.where(key > tuple_(*cursor))
+            stmt = stmt.order_by(UserPoints.username, UserPoints.user_id)
+
+        async with get_db(readonly=True) as db:
+            rows = (await db.execute(stmt.limit(limit + 1))).all()
+
+        has_more = len(rows) > limit
+        rows = [(row.username, row.user_id) for row in rows[:limit]]
+        if backward:
+            rows.reverse()
+        return rows, has_more
+
+    async def apply_point_events(self, events: list) -> dict:
+        """Append point events and update the materialized balances in one transaction.
+
+        ``events`` are dicts with chat_id, user_id, delta, username and
+        actor_id. Deltas are summed per user, so a user changed several times
+        in one batch has its row updated once. Events count towards the
+        current season of their chat. Returns the new balance of every
+        affected (chat_id, user_id).
+        """
+        seasons = await self.current_seasons({event["chat_id"] for event in events})
+        totals = {}
+        for event in events:
+            key = (event["chat_id"], event["user_id"])
+            delta, username = totals.get(key, (0, None))
+            totals[key] = (delta + event["delta"], event["username"] or username)
+
+        # Update rows in key order so concurrent batches can't deadlock
+        balance_rows = [
+            {
+                "chat_id": chat_id,
+                "season": seasons[chat_id],
+                "user_id": user_id,
+                "points": delta,
+                "username": username
+            }
+            for (chat_id, user_id), (delta, username) in sorted(totals.items())
+        ]
+        stmt = insert(UserPoints).values(balance_rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserPoints.chat_id, UserPoints.season, UserPoints.user_id],
+            set_={
+                "points": UserPoints.points + stmt.excluded.points,
+                "username": func.coalesce(stmt.excluded.username, UserPoints.username)
+            }
+        ).returning(UserPoints.chat_id, UserPoints.user_id, UserPoints.points, UserPoints.username)
+
+        async with get_db() as db:
+            await db.execute(insert(PointEvent).values([
+                {
+                    "chat_id": event["chat_id"],
+                    "user_id": event["user_id"],
+                    "delta": event["delta"],
+                    "actor_id": event["actor_id"],
+                    "season": seasons[event["chat_id"]]
+                }
+                for event in events
+            ]))
+            rows = (await db.execute(stmt)).all()
+
+        balances = {}
+        for row in rows:
+            balances[(row.chat_id, row.user_id)] = row.points
+            # Skip chats where a new season started while the batch was written
+            if self.seasons.get(row.chat_id, seasons[row.chat_id]) == seasons[row.chat_id]:
+                self.leaderboard.update(row.chat_id, row.user_id, row.points, row.username)
+        return balances
+
+    async def stream_points(self, chat_id: int, batch_size: int = 1000):
+        """Yield (user_id, username, points) of every user in a chat's current season.
+
+        Rows come through a server-side cursor ``batch_size`` at a time, so
+        the chat is never loaded into memory as a whole.
+        """
+        season = await self.current_season(chat_id)
+        async with get_db(readonly=True) as db:
+            result = await db.stream(
+                select(UserPoints.user_id, UserPoints.username, UserPoints.points)
+                .where(UserPoints.chat_id == chat_id, UserPoints.season == season)
+                .order_by(UserPoints.user_id)
+                .execution_options(yield_per=batch_size)
+            )
+            async for row in result:
+                yield row.user_id, row.username, row.points
+
+    async def import_points(self, chat_id: int, rows, actor_id: int = None,
+                            batch_size: int = 1000, progress=None) -> int:
+        """Set the balances of a chat's current season from (user_id, username, points) rows"""
+        # One transaction, one upsert per batch; changed balances go to the
+        # ledger as the difference from the old one
+        imported = 0
+        rows = iter(rows)
+        season = await self.current_season(chat_id)
+        async with get_db() as db:
+            while batch := list(islice(rows, batch_size)):
+                # A user listed twice keeps the last row; sorted to avoid deadlocks
+                latest = {user_id: (username or None, points) for user_id, username, points in batch}
+                ordered = sorted(latest.items())
+
+                # Old balances of the batch, read inside the transaction
+                result = await db.execute(
+                    select(UserPoints.user_id, UserPoints.points).where(
+                        UserPoints.chat_id == chat_id,
+                        UserPoints.season == season,
+                        UserPoints.user_id.in_(latest)
+                    )
+                )
+                old = dict(result.all())
+                changes = [
+                    {
+                        "chat_id": chat_id,
+                        "user_id": user_id,
+                        "delta": points - (old.get(user_id) or 0),
+                        "actor_id": actor_id,
+                        "season": season
+                    }
+                    for user_id, (_, points) in ordered if points != (old.get(user_id) or 0)
+                ]
+                if changes:
+                    await db.execute(insert(PointEvent).values(changes))
+
+                stmt = insert(UserPoints).values([
+                    {
+                        "chat_id": chat_id,
+                        "season": season,
+                        "user_id": user_id,
+                        "username": username,
+                        "points": points
+                    }
+                    for user_id, (username, points) in ordered
+                ])
+                await db.execute(stmt.on_conflict_do_update(
+                    index_elements=[UserPoints.chat_id, UserPoints.season, UserPoints.user_id],
+                    set_={
+                        "points": stmt.excluded.points,
+                        "username": func.coalesce(stmt.excluded.username, UserPoints.username)
+                    }
+                ))
+
+                imported += len(batch)
+                if progress is not None:
+                    # Called, not awaited: the transaction is still open
+                    progress(imported)
+
+        self.leaderboard.reset(chat_id)
+        return imported
+
+    async def compact_ledger(self, before) -> int:
+        """Roll ledger events created before ``before`` into per-user snapshots"""
+        async with get_db() as db:
+            # Every worker runs compaction; a second one waits here and then
+            # only sees the events the first left behind. SQLite's BEGIN
+            # IMMEDIATE already serialises this transaction.
+            if engine.dialect.name == "postgresql":
+                await db.execute(
+                    text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": COMPACTION_LOCK_ID}
+                )
+            last_id = (await db.execute(
+                select(func.max(PointEvent.id)).where(PointEvent.created_at < before)
+            )).scalar()
+            if last_id is None:
+                return 0
+
+            rolled_up = select(
+                PointEvent.chat_id,
+                PointEvent.season,
+                PointEvent.user_id,
+                func.sum(PointEvent.delta),
+                literal(before, DateTime(timezone=True))
+            ).where(
+                PointEvent.id <= last_id
+            ).group_by(PointEvent.chat_id, PointEvent.season, PointEvent.user_id)
+            stmt = insert(PointSnapshot).from_select(
+                ["chat_id", "season", "user_id", "points", "as_of"], rolled_up
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[PointSnapshot.chat_id, PointSnapshot.season, PointSnapshot.user_id],
+                set_={
+                    "points": PointSnapshot.points + stmt.excluded.points,
+                    "as_of": stmt.excluded.as_of
+                }
+            )
+            await db.execute(stmt)
+            result = await db.execute(delete(PointEvent).where(PointEvent.id <= last_id))
+            return result.rowcount
+
+    async def add_points(self, chat_id: int, user_id: int, points: int, username: str = None,
+                         actor_id: int = None) -> int:
+        """Add points to a user in specific chat, returning the new balance or None on failure"""
+        try:
+            return await self.ledger.append(chat_id, user_id, points, username, actor_id)
+        except Exception as e:
+            logger.error("Error in add_points: %s", e)
+            return None
+
+    async def subtract_points(self, chat_id: int, user_id: int, points: int, username: str = None,
+                              actor_id: int = None) -> int:
+        """Subtract points from a user in specific chat, returning the new balance or None on failure"""
+        try:
+            return await self.ledger.append(chat_id, user_id, -points, username, actor_id)
+        except Exception as e:
+            logger.error("Error in subtract_points: %s", e)
+            return None
+
+    async def get_user_points(self, chat_id: int, user_id: int) -> int:
+        """Get points for a specific user in specific chat"""
+        try:
+            season = await self.current_season(chat_id)
+            async with get_db(readonly=True) as db:
+                result = await db.execute(
+                    select(UserPoints.points).where(
+                        UserPoints.chat_id == chat_id,
+                        UserPoints.season == season,
+                        UserPoints.user_id == user_id
+                    ).limit(1)
+                )
+                return result.scalar() or 0
+        except Exception as e:
+            logger.error("Error in get_user_points: %s", e)
+            return 0
+
+    async def get_user_rank(self, chat_id: int, user_id: int):
+        """Return (points, rank) of a user in specific chat, or None if not in it.
+
+        Users with equal points share a rank. The rank is the number of users
+        with more points plus one in the current season, counted on the
+        (chat_id, season, points) index, or read from the cached leaderboard
+        for users near the top.
+        """
+        cached = self.leaderboard.rank(chat_id, user_id)
+        if cached is not None:
+            return cached
+
+        season = await self.current_season(chat_id)
+        ahead = aliased(UserPoints)
+        async with get_db(readonly=True) as db:
+            result = await db.execute(
+                select(
+                    UserPoints.points,
+                    select(func.count()).where(
+                        ahead.chat_id == chat_id,
+                        ahead.season == season,
+                        ahead.points > UserPoints.points
+                    ).scalar_subquery() + 1
+                ).where(
+                    UserPoints.chat_id == chat_id,
+                    UserPoints.season == season,
+                    UserPoints.user_id == user_id
+                )
+            )
+            row = result.first()
+            return tuple(row) if row is not None else None
+
+    async def get_top_users(self, chat_id: int, limit: int = 10, season: int = None) -> list:
+        """Get top users by points in specific chat, in its current season by default"""
+        try:
+            current = await self.current_season(chat_id)
+            past = season is not None and season != current
+            if not past:
+                cached = self.leaderboard.top(chat_id, limit)
+                if cached is not None:
+                    return cached
+
+            version = self.leaderboard.version(chat_id)
+            # Only the current season is kept in the cached leaderboard
+            fetch = limit if past else max(limit, self.leaderboard.capacity)
+            async with get_db(readonly=True) as db:
+                result = await db.execute(
+                    select(
+                        UserPoints.user_id,
+                        UserPoints.points,
+                        UserPoints.username
+                    ).where(
+                        UserPoints.chat_id == chat_id,
+                        UserPoints.season == (season if past else current)
+                    ).order_by(
+                        UserPoints.points.desc(),
+                        UserPoints.user_id
+                    ).limit(fetch)
+                )
+
+                users = [(user.user_id, {
+                    "points": user.points,
+                    "username": user.username
+                }) for user in result]
+
+            if not past:
+                self.leaderboard.load(chat_id, users, version)
+            return users[:limit]
+        except Exception as e:
+            logger.error("Error in get_top_users: %s", e)
+            return []
@@ -1,287 +1,739 @@
-import logging
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import (
-    ContextTypes,
-    ConversationHandler,
-    CallbackQueryHandler,
-    MessageHandler,
-    filters
-)
-import config
-from database import Database
-
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# Define states
-CHOOSING_ACTION, CHOOSING_USER, ENTERING_POINTS = range(3)
-
-# Initialize database
-db = Database()
-
-def is_admin(user_id: int) -> bool:
-    """Check if user is admin"""
-    return user_id == config.ADMIN_USER_ID
-
-async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle regular messages to track users"""
-    try:
-        user = update.effective_user
-        chat = update.effective_chat
-
-        if user and chat and user.username:
-            # Add user to database with 0 points if they don't exist
-            success = db.add_points(chat.id, user.id, 0, user.username)
-            if success:
-                logger.info(f"Successfully tracked user {user.username} with ID {user.id} in chat {chat.id}")
-            else:
-                logger.error(f"Failed to track user {user.username} in chat {chat.id}")
-    except Exception as e:
-        logger.error(f"Error handling user message: {str(e)}")
-
-async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle the /a command"""
-    try:
-        user = update.effective_user
-        if not user:
-            return ConversationHandler.END
-
-        if not is_admin(user.id):
-            await update.message.reply_text(config.NOT_ADMIN_MESSAGE)
-            return ConversationHandler.END
-
-        # Store the command message ID for later deletion
-        context.user_data['messages_to_delete'] = [update.message.message_id]
-
-        keyboard = [
-            [
-                InlineKeyboardButton("Додати бали", callback_data='add'),
-                InlineKeyboardButton("Забрати бали", callback_data='subtract')
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        menu_message = await update.message.reply_text(
-            text="Оберіть дію:",
-            reply_markup=reply_markup
-        )
-        # Store menu message ID
-        context.user_data['messages_to_delete'].append(menu_message.message_id)
-        return CHOOSING_ACTION
-    except Exception as e:
-        logger.error(f"Error in admin_command: {str(e)}")
-        return ConversationHandler.END
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle the /help command"""
-    try:
-        await update.message.reply_text(config.HELP_MESSAGE)
-    except Exception as e:
-        logger.error(f"Error in help_command: {str(e)}")
-
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle button callbacks"""
-    try:
-        query = update.callback_query
-        chat_id = query.message.chat_id
-        await query.answer()
-
-        if not is_admin(update.effective_user.id):
-            await query.message.edit_text(config.NOT_ADMIN_MESSAGE)
-            return ConversationHandler.END
-
-        action = query.data
-
-        # Handle finish action
-        if action == 'finish':
-            # Delete the original command message and all bot responses
-            if 'messages_to_delete' in context.user_data:
-                for message_id in context.user_data['messages_to_delete']:
-                    try:
-                        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-                    except Exception as e:
-                        logger.error(f"Error deleting message {message_id}: {str(e)}")
-                        continue
-
-            # Delete the current menu message
-            try:
-                await query.message.delete()
-            except Exception as e:
-                logger.error(f"Error deleting menu message: {str(e)}")
-
-            context.user_data.clear()
-            return ConversationHandler.END
-
-        context.user_data['action'] = action
-        context.user_data['chat_id'] = chat_id
-
-        users = db.get_all_users(chat_id)
-        keyboard = []
-        for username in users:
-            keyboard.append([InlineKeyboardButton(f"@{username}", callback_data=f"user_{username}")])
-
-        keyboard.append([InlineKeyboardButton("Завершити", callback_data='finish')])
-
-        if not keyboard:
-            message = await query.message.edit_text("Наразі немає користувачів у цьому чаті.")
-            if 'messages_to_delete' not in context.user_data:
-                context.user_data['messages_to_delete'] = []
-            context.user_data['messages_to_delete'].append(message.message_id)
-            return ConversationHandler.END
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        text = "додати" if action == "add" else "забрати"
-
-        # Store the current message for deletion
-        try:
-            menu_message = await query.message.edit_text(
-                f"Оберіть користувача, якому хочете {text} бали:",
-                reply_markup=reply_markup
-            )
-            if 'messages_to_delete' not in context.user_data:
-                context.user_data['messages_to_delete'] = []
-            context.user_data['messages_to_delete'].append(menu_message.message_id)
-        except Exception as e:
-            logger.error(f"Error updating menu message: {str(e)}")
-
-        return CHOOSING_USER
-
-    except Exception as e:
-        logger.error(f"Error in button_callback: {str(e)}")
-        return ConversationHandler.END
-
-async def user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle user selection"""
-    try:
-        query = update.callback_query
-        await query.answer()
-
-        username = query.data.replace("user_", "")
-        context.user_data['username'] = username
-
-        action = context.user_data.get('action')
-        if not action:
-            logger.error("No action found in context")
-            return ConversationHandler.END
-
-        text = "додати" if action == "add" else "забрати"
-        await query.message.edit_text(
-            f"Введіть кількість балів, які хочете {text} для користувача @{username}:"
-        )
-        return ENTERING_POINTS
-    except Exception as e:
-        logger.error(f"Error in user_callback: {str(e)}")
-        return ConversationHandler.END
-
-async def points_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle points entry"""
-    try:
-        if 'messages_to_delete' not in context.user_data:
-            context.user_data['messages_to_delete'] = []
-
-        # Store user's points message for deletion
-        context.user_data['messages_to_delete'].append(update.message.message_id)
-
-        points = int(update.message.text)
-        chat_id = context.user_data.get('chat_id')
-
-        if points <= 0:
-            message = await update.message.reply_text("Кількість балів повинна бути додатньою!")
-            context.user_data['messages_to_delete'].append(message.message_id)
-            return ENTERING_POINTS
-
-        username = context.user_data.get('username')
-        action = context.user_data.get('action')
-
-        if not username or not action or not chat_id:
-            logger.error("Missing username, action or chat_id in context")
-            return ConversationHandler.END
-
-        user_id = db.get_user_id_by_username(chat_id, username)
-        if user_id is None:
-            user_id = -abs(hash(username))
-            logger.info(f"Creating temporary user ID {user_id} for username {username}")
-
-        if action == 'add':
-            db.add_points(chat_id, user_id, points, username)
-            message = f"{config.POINTS_UPDATED_MESSAGE} Користувач: @{username}, Бали: +{points}"
-        else:
-            db.subtract_points(chat_id, user_id, points, username)
-            message = f"{config.POINTS_UPDATED_MESSAGE} Користувач: @{username}, Бали: -{points}"
-
-        keyboard = [
-            [
-                InlineKeyboardButton("Додати бали", callback_data='add'),
-                InlineKeyboardButton("Забрати бали", callback_data='subtract')
-            ],
-            [InlineKeyboardButton("Завершити", callback_data='finish')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-
-        # Store all bot responses for deletion
-        result_message = await update.message.reply_text(message)
-        menu_message = await update.message.reply_text(
-            text="Оберіть наступну дію:",
-            reply_markup=reply_markup
-        )
-
-        context.user_data['messages_to_delete'].extend([
-            result_message.message_id,
-            menu_message.message_id
-        ])
-
-        return CHOOSING_ACTION
-    except ValueError:
-        message = await update.message.reply_text("Будь ласка, введіть числове значення!")
-        context.user_data['messages_to_delete'].append(message.message_id)
-        return ENTERING_POINTS
-    except Exception as e:
-        logger.error(f"Error in points_entered: {str(e)}")
-        return ConversationHandler.END
-
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Cancel the conversation"""
-    try:
-        context.user_data.clear()
-        await update.message.reply_text("Операцію скасовано.")
-        return ConversationHandler.END
-    except Exception as e:
-        logger.error(f"Error in cancel: {str(e)}")
-        return ConversationHandler.END
-
-async def clear_all_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle the /allclear command"""
-    try:
-        if not is_admin(update.effective_user.id):
-            await update.message.reply_text(config.NOT_ADMIN_MESSAGE)
-            return
-
-        chat_id = update.effective_chat.id
-        db.clear_all_points(chat_id)
-        await update.message.reply_text("Всі бали були успішно очищені!")
-    except Exception as e:
-        logger.error(f"Error in clear_all_points: {str(e)}")
-
-async def show_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle the /top command"""
-    try:
-        chat_id = update.effective_chat.id
-        top_users = db.get_top_users(chat_id, 10)
-
-        if not top_users:
-            await update.message.reply_text("В базі даних ще немає користувачів!")
-            return
-
-        message = "⚠️👀 Люди, Що Бачили Все! 👀⚠️\n\n"
-        for i, (user_id, user_data) in enumerate(top_users, 1):
-            username = user_data["username"] or f"User {user_id}"
-            emoji = "👑" if i == 1 else "🏆" if i == 2 else "🐉" if i == 3 else "🚀"
-            message += f"{i}. {emoji} @{username}: {user_data['points']} балів\n"
-
-        await update.message.reply_text(message)
-    except Exception as e:
-        logger.error(f"Error in show_top: {str(e)}")
+import asyncio
+import io
+import logging
+import re
+import tempfile
+import time
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import (
+    ContextTypes,
+    ConversationHandler,
+    CallbackQueryHandler,
+    MessageHandler,
+    filters
+)
+import config
+import metrics
+from admins import ADMIN_STATUSES, ChatAdmins
+from cache import TTLCache
+from database import Database
+from outbox import Outbox
+import transfer
+from logs import audit
+from write_buffer import TrackingBuffer
+
+logger = logging.getLogger(__name__)
+
+# Define states
+CHOOSING_ACTION, CHOOSING_USER, ENTERING_POINTS, SEARCHING_USER = range(4)
+
+# Initialize database
+db = Database()
+
+# Last username stored for each (chat_id, user_id), so repeat messages skip the database
+member_cache = TTLCache(config.MEMBER_CACHE_SIZE, config.MEMBER_CACHE_TTL)
+metrics.Gauge("bot_member_cache_hits_total", "Tracked messages that skipped the database",
+              lambda: member_cache.hits, metric_type="counter")
+metrics.Gauge("bot_member_cache_misses_total", "Tracked messages that had to be written",
+              lambda: member_cache.misses, metric_type="counter")
+metrics.Gauge("bot_member_cache_size", "Entries in the known-member cache",
+              lambda: len(member_cache))
+
+# Tracking upserts are batched and written behind the message handler
+tracking_buffer = TrackingBuffer(
+    db, config.TRACKING_BATCH_SIZE, config.TRACKING_FLUSH_INTERVAL, config.TRACKING_MAX_PENDING
+)
+
+# Telegram administrators and allow-listed users of each chat
+chat_admins = ChatAdmins(db, config.ADMIN_CACHE_REFRESH, config.ADMIN_CACHE_TTL, config.ADMIN_CACHE_SIZE)
+
+# Outgoing messages go through global and per-chat rate limits; deletions are batched
+outbox = Outbox(
+    # Each worker process gets its share of the bot-wide limit
+    config.OUTBOX_GLOBAL_RATE / max(config.WORKERS, 1),
+    config.OUTBOX_CHAT_RATE,
+    config.OUTBOX_CHAT_BURST,
+    config.OUTBOX_DELETE_LINGER,
+    config.OUTBOX_MAX_RETRIES
+)
+
+# "@username +N" / "@username -N" / "@username N" pairs for /ab. The name
+# must end where the word does, so "@bob12" isn't read as "@bob1 2"
+BULK_ENTRY_PATTERN = re.compile(r"@(\w{1,32})(?!\w)(?:\s+|(?=[+-]))([+-]?\d+)(?!\w)")
+# Every @-token that should start a pair; "/ab@points_bot" and e-mails are not
+BULK_MENTION_PATTERN = re.compile(r"(?<!\w)@\S*")
+
+def temporary_user_id(username: str) -> int:
+    """Placeholder ID for a username the bot hasn't seen yet"""
+    return -abs(hash(username))
+
+def is_superadmin(user_id: int) -> bool:
+    """Check if user is the bot owner, who is admin in every chat"""
+    return user_id == config.ADMIN_USER_ID
+
+async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Check if the sender may manage points in the chat of the update"""
+    user = update.effective_user
+    chat = update.effective_chat
+    if not user or not chat:
+        return False
+    if is_superadmin(user.id):
+        return True
+    try:
+        return await chat_admins.is_admin(context.bot, chat, user.id)
+    except Exception as e:
+        logger.error("Error checking admin rights of %s in chat %s: %s", user.id, chat.id, e)
+        return False
+
+async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle regular messages to track users"""
+    try:
+        user = update.effective_user
+        chat = update.effective_chat
+
+        if user and chat and user.username:
+            key = (chat.id, user.id)
+            if member_cache.get(key) == user.username:
+                return
+
+            # Queue the user for a batched upsert with 0 points if they don't exist
+            tracking_buffer.add(chat.id, user.id, user.username)
+            member_cache.set(key, user.username)
+            logger.info("Queued tracking of user %s with ID %s in chat %s", user.username, user.id, chat.id,
+                        extra={"event": "message_tracked"})
+    except Exception as e:
+        logger.error("Error handling user message: %s", e)
+
+async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /a command"""
+    try:
+        user = update.effective_user
+        if not user:
+            return ConversationHandler.END
+
+        if not await is_admin(update, context):
+            await outbox.reply(update.message, config.NOT_ADMIN_MESSAGE)
+            return ConversationHandler.END
+
+        # Store the command message ID for later deletion
+        context.user_data['messages_to_delete'] = [update.message.message_id]
+        context.user_data['chat_id'] = update.effective_chat.id
+
+        keyboard = [
+            [
+                InlineKeyboardButton("Додати бали", callback_data='add'),
+                InlineKeyboardButton("Забрати бали", callback_data='subtract')
+            ]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        menu_message = await outbox.reply(
+            update.message,
+            text="Оберіть дію:",
+            reply_markup=reply_markup
+        )
+        # Store menu message ID
+        context.user_data['messages_to_delete'].append(menu_message.message_id)
+        return CHOOSING_ACTION
+    except Exception as e:
+        logger.error("Error in admin_command: %s", e)
+        return ConversationHandler.END
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /help command"""
+    try:
+        await outbox.reply(update.message, config.HELP_MESSAGE)
+    except Exception as e:
+        logger.error("Error in help_command: %s", e)
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle button callbacks"""
+    try:
+        query = update.callback_query
+        chat_id = query.message.chat_id
+        await query.answer()
+
+        if not await is_admin(update, context):
+            await outbox.edit(query.message, config.NOT_ADMIN_MESSAGE)
+            return ConversationHandler.END
+
+        action = query.data
+
+        # Handle finish action
+        if action == 'finish':
+            # Delete the original command message, all bot responses and the
+            # current menu in bulk, without waiting for Telegram
+            message_ids = context.user_data.get('messages_to_delete', [])
+            outbox.delete(chat_id, message_ids + [query.message.message_id])
+
+            context.user_data.clear()
+            return ConversationHandler.END
+
+        context.user_data['action'] = action
+        context.user_data['chat_id'] = chat_id
+        context.user_data.pop('search', None)
+
+        await show_user_page(query.message, context)
+        return CHOOSING_USER
+
+    except Exception as e:
+        logger.error("Error in button_callback: %s", e)
+        return ConversationHandler.END
+
+def encode_cursor(direction: str, username: str, user_id: int) -> str:
+    """Pack a keyset cursor into callback data: pg:<direction>:<user_id>:<username>"""
+    return f"pg:{direction}:{user_id}:{username}"
+
+def decode_cursor(data: str) -> tuple:
+    """Unpack callback data built by encode_cursor into (backward, (username, user_id))"""
+    _, direction, user_id, username = data.split(":", 3)
+    return direction == "<", (username, int(user_id))
+
+async def show_user_page(message, context: ContextTypes.DEFAULT_TYPE, cursor: tuple = None,
+                         backward: bool = False, edit: bool = True):
+    """Render one page of the user picker, editing ``message`` or replying to it"""
+    chat_id = context.user_data['chat_id']
+    prefix = context.user_data.get('search')
+    users, has_more = await db.get_users_page(
+        chat_id, cursor, backward, prefix, config.USER_PAGE_SIZE
+    )
+
+    # Moving in one direction always leaves a page behind in the other
+    has_prev = has_more if backward else cursor is not None
+    has_next = cursor is not None if backward else has_more
+
+    keyboard = [
+        [InlineKeyboardButton(f"@{username}", callback_data=f"user_{username}")]
+        for username, _ in users
+    ]
+
+    navigation = []
+    if users and has_prev:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=encode_cursor("<", *users[0])))
+    if users and has_next:
+        navigation.append(InlineKeyboardButton("Далі ▶️", callback_data=encode_cursor(">", *users[-1])))
+    if navigation:
+        keyboard.append(navigation)
+
+    keyboard.append([InlineKeyboardButton("🔍 Пошук", callback_data='search')])
+    keyboard.append([InlineKeyboardButton("Завершити", callback_data='finish')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    if users:
+        text = "додати" if context.user_data.get('action') == "add" else "забрати"
+        text = f"Оберіть користувача, якому хочете {text} бали:"
+        if prefix:
+            text += f"\n🔍 @{prefix}…"
+    elif prefix:
+        text = f"Користувачів, що починаються з @{prefix}, не знайдено."
+    else:
+        text = "Наразі немає користувачів у цьому чаті."
+
+    # Store the current message for deletion
+    try:
+        if edit:
+            menu_message = await outbox.edit(message, text, reply_markup=reply_markup)
+        else:
+            menu_message = await outbox.reply(message, text, reply_markup=reply_markup)
+        if 'messages_to_delete' not in context.user_data:
+            context.user_data['messages_to_delete'] = []
+        context.user_data['messages_to_delete'].append(menu_message.message_id)
+    except Exception as e:
+        logger.error("Error updating menu message: %s", e)
+
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle next/previous page buttons in the user picker"""
+    try:
+        query = update.callback_query
+        await query.answer()
+
+        if 'chat_id' not in context.user_data:
+            logger.error("No chat_id found in context")
+            return ConversationHandler.END
+
+        backward, cursor = decode_cursor(query.data)
+        await show_user_page(query.message, context, cursor, backward)
+        return CHOOSING_USER
+    except Exception as e:
+        logger.error("Error in page_callback: %s", e)
+        return ConversationHandler.END
+
+async def search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ask the admin for the start of a username"""
+    try:
+        query = update.callback_query
+        await query.answer()
+        await outbox.edit(query.message, "Введіть початок імені користувача:")
+        return SEARCHING_USER
+    except Exception as e:
+        logger.error("Error in search_callback: %s", e)
+        return ConversationHandler.END
+
+async def search_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the users whose names start with the entered text"""
+    try:
+        if 'messages_to_delete' not in context.user_data:
+            context.user_data['messages_to_delete'] = []
+        context.user_data['messages_to_delete'].append(update.message.message_id)
+
+        if 'chat_id' not in context.user_data:
+            logger.error("No chat_id found in context")
+            return ConversationHandler.END
+
+        prefix = update.message.text.strip().lstrip('@')
+        if prefix:
+            context.user_data['search'] = prefix
+        else:
+            context.user_data.pop('search', None)
+
+        await show_user_page(update.message, context, edit=False)
+        return CHOOSING_USER
+    except Exception as e:
+        logger.error("Error in search_entered: %s", e)
+        return ConversationHandler.END
+
+async def user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle user selection"""
+    try:
+        query = update.callback_query
+        await query.answer()
+
+        username = query.data[len("user_"):]
+        context.user_data['username'] = username
+
+        action = context.user_data.get('action')
+        if not action:
+            logger.error("No action found in context")
+            return ConversationHandler.END
+
+        text = "додати" if action == "add" else "забрати"
+        await outbox.edit(
+            query.message,
+            f"Введіть кількість балів, які хочете {text} для користувача @{username}:"
+        )
+        return ENTERING_POINTS
+    except Exception as e:
+        logger.error("Error in user_callback: %s", e)
+        return ConversationHandler.END
+
+async def points_entered(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle points entry"""
+    try:
+        if 'messages_to_delete' not in context.user_data:
+            context.user_data['messages_to_delete'] = []
+
+        # Store user's points message for deletion
+        context.user_data['messages_to_delete'].append(update.message.message_id)
+
+        points = int(update.message.text)
+        chat_id = context.user_data.get('chat_id')
+
+        if points <= 0:
+            message = await outbox.reply(update.message, "Кількість балів повинна бути додатньою!")
+            context.user_data['messages_to_delete'].append(message.message_id)
+            return ENTERING_POINTS
+
+        username = context.user_data.get('username')
+        action = context.user_data.get('action')
+
+        if not username or not action or not chat_id:
+            logger.error("Missing username, action or chat_id in context")
+            return ConversationHandler.END
+
+        user_id = await db.get_user_id_by_username(chat_id, username)
+        if user_id is None:
+            user_id = temporary_user_id(username)
+            logger.info("Creating temporary user ID %s for username %s", user_id, username)
+
+        actor_id = update.effective_user.id
+        if action == 'add':
+            balance = await db.add_points(chat_id, user_id, points, username, actor_id)
+            sign = "+"
+        else:
+            balance = await db.subtract_points(chat_id, user_id, points, username, actor_id)
+            sign = "-"
+
+        # None means the change wasn't written; the menu stays open to retry
+        if balance is None:
+            message = "Не вдалося оновити бали, жодних змін не внесено."
+        else:
+            message = (f"{config.POINTS_UPDATED_MESSAGE} Користувач: @{username}, "
+                       f"Бали: {sign}{points} (всього: {balance})")
+            audit.info("Admin %s changed points of %s in chat %s by %+d, balance %s",
+                       actor_id, user_id, chat_id, points if action == 'add' else -points, balance)
+
+        keyboard = [
+            [
+                InlineKeyboardButton("Додати бали", callback_data='add'),
+                InlineKeyboardButton("Забрати бали", callback_data='subtract')
+            ],
+            [InlineKeyboardButton("Завершити", callback_data='finish')]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        # Store all bot responses for deletion
+        result_message = await outbox.reply(update.message, message)
+        menu_message = await outbox.reply(
+            update.message,
+            text="Оберіть наступну дію:",
+            reply_markup=reply_markup
+        )
+
+        context.user_data['messages_to_delete'].extend([
+            result_message.message_id,
+            menu_message.message_id
+        ])
+
+        return CHOOSING_ACTION
+    except ValueError:
+        message = await outbox.reply(update.message, "Будь ласка, введіть числове значення!")
+        context.user_data['messages_to_delete'].append(message.message_id)
+        return ENTERING_POINTS
+    except Exception as e:
+        logger.error("Error in points_entered: %s", e)
+        return ConversationHandler.END
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel the conversation"""
+    try:
+        context.user_data.clear()
+        await outbox.reply(update.message, "Операцію скасовано.")
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error("Error in cancel: %s", e)
+        return ConversationHandler.END
+
+async def clear_all_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /allclear command"""
+    try:
+        if not await is_admin(update, context):
+            await outbox.reply(update.message, config.NOT_ADMIN_MESSAGE)
+            return
+
+        chat_id = update.effective_chat.id
+        season = await db.clear_all_points(chat_id, update.effective_user.id)
+        # Members are known to the old season only; track them again on their next message
+        member_cache.discard_where(lambda key: key[0] == chat_id)
+        audit.info("Admin %s started season %s in chat %s", update.effective_user.id, season, chat_id)
+        await outbox.reply(
+            update.message,
+            f"Розпочато сезон {season + 1}, всі бали обнулено! Рейтинг минулого сезону: /lasttop"
+        )
+    except Exception as e:
+        logger.error("Error in clear_all_points: %s", e)
+
+def parse_bulk_entries(text: str) -> tuple:
+    """Sum the point deltas per username in a bulk assignment.
+
+    Returns the deltas and the @-tokens that aren't a valid "@username N"
+    pair. Usernames are case-insensitive; the first spelling is kept.
+    """
+    deltas = {}
+    spellings = {}
+    invalid = []
+    for mention in BULK_MENTION_PATTERN.finditer(text):
+        entry = BULK_ENTRY_PATTERN.match(text, mention.start())
+        if entry is None:
+            invalid.append(mention.group())
+            continue
+        username = spellings.setdefault(entry.group(1).lower(), entry.group(1))
+        deltas[username] = deltas.get(username, 0) + int(entry.group(2))
+    return deltas, invalid
+
+async def bulk_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /ab command: apply many @username ±N pairs at once"""
+    try:
+        if not await is_admin(update, context):
+            await outbox.reply(update.message, config.NOT_ADMIN_MESSAGE)
+            return
+
+        # The list can follow the command or be in the message it replies to
+        text = update.message.text or ""
+        if update.message.reply_to_message and update.message.reply_to_message.text:
+            text += "\n" + update.message.reply_to_message.text
+
+        deltas, invalid = parse_bulk_entries(text)
+        if invalid:
+            await outbox.reply(
+                update.message,
+                f"Не вдалося розібрати: {', '.join(invalid)}. Жодних змін не внесено.\n\n"
+                + config.BULK_USAGE_MESSAGE
+            )
+            return
+        deltas = {username: points for username, points in deltas.items() if points}
+        if not deltas:
+            await outbox.reply(update.message, config.BULK_USAGE_MESSAGE)
+            return
+
+        chat_id = update.effective_chat.id
+        actor_id = update.effective_user.id
+        members = await db.resolve_usernames(chat_id, list(deltas))
+
+        events = []
+        user_ids = {}
+        for username, points in deltas.items():
+            # A known member keeps their stored username, whatever case it was typed in
+            user_id, stored_username = members.get(username, (None, username))
+            if user_id is None:
+                user_id = temporary_user_id(username)
+                logger.info("Creating temporary user ID %s for username %s", user_id, username)
+            user_ids[username] = user_id
+            events.append({
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "delta": points,
+                "username": stored_username,
+                "actor_id": actor_id
+            })
+
+        balances = await db.apply_point_events(events)
+        audit.info("Admin %s applied %s bulk point changes in chat %s", actor_id, len(events), chat_id)
+
+        lines = [f"{config.POINTS_UPDATED_MESSAGE} Користувачів: {len(events)}"]
+        for username, points in deltas.items():
+            balance = balances[(chat_id, user_ids[username])]
+            lines.append(f"@{username}: {points:+d} (всього: {balance})")
+        await outbox.reply(update.message, "\n".join(lines))
+    except Exception as e:
+        logger.error("Error in bulk_points: %s", e)
+        await outbox.reply(update.message, "Не вдалося оновити бали, жодних змін не внесено.")
+
+async def export_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /export command: send the chat's points as a CSV or JSON file"""
+    try:
+        if not await is_admin(update, context):
+            await outbox.reply(update.message, config.NOT_ADMIN_MESSAGE)
+            return
+
+        fmt = context.args[0].lower() if context.args else "csv"
+        if fmt not in transfer.FORMATS:
+            await outbox.reply(update.message, config.EXPORT_USAGE_MESSAGE)
+            return
+
+        chat_id = update.effective_chat.id
+        # Rows are streamed into a temporary file, not collected in memory
+        with tempfile.TemporaryFile() as file:
+            text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+            count = await transfer.export_points(db, chat_id, text, fmt)
+            text.flush()
+            text.detach()
+
+            async def send_file():
+                # Rewound on every attempt in case flood control asks for a retry
+                file.seek(0)
+                return await update.message.reply_document(
+                    file,
+                    filename=f"points_{chat_id}.{fmt}",
+                    caption=f"Експортовано користувачів: {count}"
+                )
+
+            await outbox.send(chat_id, send_file)
+        audit.info("Admin %s exported %s rows from chat %s", update.effective_user.id, count, chat_id)
+    except Exception as e:
+        logger.error("Error in export_points: %s", e)
+
+async def import_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /import command sent in reply to a CSV or JSON file"""
+    try:
+        if not await is_admin(update, context):
+            await outbox.reply(update.message, config.NOT_ADMIN_MESSAGE)
+            return
+
+        reply = update.message.reply_to_message
+        document = reply.document if reply else None
+        if document is None:
+            await outbox.reply(update.message, config.IMPORT_USAGE_MESSAGE)
+            return
+
+        chat_id = update.effective_chat.id
+        fmt = transfer.detect_format(document.file_name)
+        telegram_file = await document.get_file()
+        data = await telegram_file.download_as_bytearray()
+        source = io.StringIO(data.decode("utf-8-sig"), newline="")
+
+        status = await outbox.reply(update.message, "Імпорт балів...")
+        last_report = time.monotonic()
+        report = None
+
+        def progress(done: int):
+            nonlocal last_report, report
+            # Called inside the import transaction, so the edit is sent in the
+            # background; at most every few seconds to stay clear of flood limits
+            if time.monotonic() - last_report >= 3 and (report is None or report.done()):
+                last_report = time.monotonic()
+                report = asyncio.create_task(
+                    outbox.edit(status, f"Імпорт балів... оброблено рядків: {done}")
+                )
+
+        try:
+            count = await transfer.import_points(
+                db, chat_id, source, fmt, update.effective_user.id, progress
+            )
+        except (ValueError, UnicodeDecodeError) as e:
+            count, error = None, e
+        # A progress edit still in flight must not overwrite the final message
+        if report is not None:
+            await asyncio.gather(report, return_exceptions=True)
+        if count is None:
+            await outbox.edit(status, f"Файл не імпортовано, жодних змін не внесено: {error}")
+            return
+
+        audit.info("Admin %s imported %s rows into chat %s", update.effective_user.id, count, chat_id)
+        await outbox.edit(status, f"Імпорт завершено. Оновлено користувачів: {count}")
+    except Exception as e:
+        logger.error("Error in import_points: %s", e)
+        await outbox.reply(update.message, "Не вдалося імпортувати бали, жодних змін не внесено.")
+
+async def chat_member_updated(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop the cached admins of a chat when someone gains or loses admin rights"""
+    try:
+        member_update = update.chat_member or update.my_chat_member
+        was_admin = member_update.old_chat_member.status in ADMIN_STATUSES
+        is_now_admin = member_update.new_chat_member.status in ADMIN_STATUSES
+        if was_admin != is_now_admin:
+            chat_admins.invalidate(member_update.chat.id)
+            logger.info("Admin rights of %s changed in chat %s",
+                        member_update.new_chat_member.user.id, member_update.chat.id)
+    except Exception as e:
+        logger.error("Error in chat_member_updated: %s", e)
+
+async def can_manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Only the bot owner and the chat's Telegram administrators edit the allow-list"""
+    user_id = update.effective_user.id
+    if is_superadmin(user_id):
+        return True
+    try:
+        return await chat_admins.is_chat_administrator(context.bot, update.effective_chat, user_id)
+    except Exception as e:
+        logger.error("Error checking admin rights of %s: %s", user_id, e)
+        return False
+
+async def admin_target(update: Update) -> tuple:
+    """Find the user an /aa or /ar command is about: a replied-to message or @username"""
+    message = update.message
+    if message.reply_to_message and message.reply_to_message.from_user:
+        user = message.reply_to_message.from_user
+        return user.id, f"@{user.username}" if user.username else user.full_name
+
+    parts = message.text.split()
+    if len(parts) < 2:
+        return None, None
+    username = parts[1].lstrip('@')
+    user_id = await db.get_user_id_by_username(update.effective_chat.id, username)
+    return user_id, f"@{username}"
+
+async def add_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /aa command: let a user manage points in this chat"""
+    try:
+        if not await can_manage_admins(update, context):
+            await outbox.reply(update.message, config.NOT_ADMIN_MESSAGE)
+            return
+
+        user_id, label = await admin_target(update)
+        if label is None:
+            await outbox.reply(update.message, config.CHAT_ADMIN_USAGE_MESSAGE)
+            return
+        if user_id is None:
+            await outbox.reply(update.message, config.USER_NOT_FOUND_MESSAGE)
+            return
+
+        chat_id = update.effective_chat.id
+        added = await db.add_chat_admin(chat_id, user_id, update.effective_user.id)
+        chat_admins.invalidate(chat_id)
+        audit.info("Admin %s allow-listed %s in chat %s", update.effective_user.id, user_id, chat_id)
+        if added:
+            await outbox.reply(update.message, f"{label} тепер може керувати балами в цьому чаті.")
+        else:
+            await outbox.reply(update.message, f"{label} вже може керувати балами в цьому чаті.")
+    except Exception as e:
+        logger.error("Error in add_chat_admin: %s", e)
+
+async def remove_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /ar command: take allow-listed rights away from a user"""
+    try:
+        if not await can_manage_admins(update, context):
+            await outbox.reply(update.message, config.NOT_ADMIN_MESSAGE)
+            return
+
+        user_id, label = await admin_target(update)
+        if label is None:
+            await outbox.reply(update.message, config.CHAT_ADMIN_USAGE_MESSAGE)
+            return
+        if user_id is None:
+            await outbox.reply(update.message, config.USER_NOT_FOUND_MESSAGE)
+            return
+
+        chat_id = update.effective_chat.id
+        removed = await db.remove_chat_admin(chat_id, user_id)
+        chat_admins.invalidate(chat_id)
+        audit.info("Admin %s removed %s from the allow-list of chat %s", update.effective_user.id, user_id, chat_id)
+        if removed:
+            await outbox.reply(update.message, f"{label} більше не може керувати балами в цьому чаті.")
+        else:
+            await outbox.reply(update.message, f"{label} немає в списку адміністраторів бота.")
+    except Exception as e:
+        logger.error("Error in remove_chat_admin: %s", e)
+
+async def show_rank(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /rank and /me commands: the caller's points and place in the chat"""
+    try:
+        user = update.effective_user
+        chat_id = update.effective_chat.id
+        result = await db.get_user_rank(chat_id, user.id)
+        name = f"@{user.username}" if user.username else user.full_name
+        if result is None:
+            await outbox.reply(update.message, f"{name}, у вас ще немає балів у цьому чаті.")
+            return
+
+        points, rank = result
+        await outbox.reply(update.message, f"{name}, у вас {points} балів, місце в рейтингу: {rank}")
+    except Exception as e:
+        logger.error("Error in show_rank: %s", e)
+
+def format_top(title: str, top_users: list) -> str:
+    """Render leaderboard rows as the /top message"""
+    message = f"{title}\n\n"
+    for i, (user_id, user_data) in enumerate(top_users, 1):
+        username = user_data["username"] or f"User {user_id}"
+        emoji = "👑" if i == 1 else "🏆" if i == 2 else "🐉" if i == 3 else "🚀"
+        message += f"{i}. {emoji} @{username}: {user_data['points']} балів\n"
+    return message
+
+async def show_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /top command"""
+    try:
+        chat_id = update.effective_chat.id
+
+        # Serve repeated /top calls from the cached leaderboard text
+        message = db.leaderboard.get_text(chat_id)
+        if message is not None:
+            await outbox.reply(update.message, message)
+            return
+
+        version = db.leaderboard.version(chat_id)
+        top_users = await db.get_top_users(chat_id, 10)
+
+        if not top_users:
+            await outbox.reply(update.message, "В базі даних ще немає користувачів!")
+            return
+
+        message = format_top("⚠️👀 Люди, Що Бачили Все! 👀⚠️", top_users)
+        db.leaderboard.set_text(chat_id, message, version)
+        await outbox.reply(update.message, message)
+    except Exception as e:
+        logger.error("Error in show_top: %s", e)
+
+async def show_last_top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the /lasttop command: the top of the chat's previous season"""
+    try:
+        chat_id = update.effective_chat.id
+        season = await db.current_season(chat_id)
+        top_users = await db.get_top_users(chat_id, 10, season - 1) if season > 0 else []
+
+        if not top_users:
+            await outbox.reply(update.message, "Минулого сезону в цьому чаті ще не було!")
+            return
+
+        await outbox.reply(update.message, format_top(f"🏁 Підсумки сезону {season} 🏁", top_users))
+    except Exception as e:
+        logger.error("Error in show_last_top: %s", e)
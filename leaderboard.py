@@ -0,0 +1,156 @@
+import time
+
+class ChatBoard:
+    """Cached top of one chat's standings"""
+
+    __slots__ = ("entries", "complete", "text", "expires_at")
+
+    def __init__(self, entries: dict, complete: bool, expires_at: float):
+        # user_id -> (points, username)
+        self.entries = entries
+        # True when entries hold every row of the chat, not just its top
+        self.complete = complete
+        self.text = None
+        self.expires_at = expires_at
+
+    def ranked(self) -> list:
+        return sorted(self.entries.items(), key=lambda item: (-item[1][0], item[0]))
+
+    def lowest(self) -> int:
+        return min(points for points, _ in self.entries.values())
+
+class LeaderboardCache:
+    """Per-chat top-N standings kept in memory and updated in place.
+
+    Each chat is warmed lazily with the top ``limit + reserve`` rows. The
+    extra rows let the board absorb score drops without going back to the
+    database; the board is dropped and re-warmed once it can no longer
+    prove that it holds the real top ``limit``.
+    """
+
+    def __init__(self, limit: int = 10, reserve: int = 10, ttl: float = 300):
+        self.limit = limit
+        self.capacity = limit + reserve
+        self.ttl = ttl
+        self._boards = {}
+        self._versions = {}
+
+    def version(self, chat_id: int) -> int:
+        """Return a counter that changes whenever the chat's scores change"""
+        return self._versions.get(chat_id, 0)
+
+    def _touch(self, chat_id: int):
+        self._versions[chat_id] = self._versions.get(chat_id, 0) + 1
+
+    def _board(self, chat_id: int):
+        board = self._boards.get(chat_id)
+        if board is not None and board.expires_at <= time.monotonic():
+            del self._boards[chat_id]
+            return None
+        return board
+
+    def top(self, chat_id: int, limit: int):
+        """Return the cached top ``limit`` rows, or None if the chat is cold"""
+        if limit > self.limit:
+            return None
+        board = self._board(chat_id)
+        if board is None:
+            return None
+        return [(user_id, {"points": points, "username": username})
+                for user_id, (points, username) in board.ranked()[:limit]]
+
+    def rank(self, chat_id: int, user_id: int):
+        """Return (points, rank) of a user on the cached board, or None.
+
+        Everyone off the board scores at most its lowest entry, so for a user
+        on it the players ahead are all on the board too.
+        """
+        board = self._board(chat_id)
+        if board is None or user_id not in board.entries:
+            return None
+        points = board.entries[user_id][0]
+        ahead = sum(1 for other, _ in board.entries.values() if other > points)
+        return points, ahead + 1
+
+    def load(self, chat_id: int, rows: list, version: int):
+        """Warm a chat from ``rows`` fetched while the chat was at ``version``"""
+        if self.version(chat_id) != version:
+            # Scores changed while the rows were being read
+            return
+        entries = {user_id: (data["points"], data["username"]) for user_id, data in rows}
+        self._boards[chat_id] = ChatBoard(
+            entries,
+            len(rows) < self.capacity,
+            time.monotonic() + self.ttl
+        )
+
+    def update(self, chat_id: int, user_id: int, points: int, username: str = None):
+        """Record a user's new balance"""
+        self._touch(chat_id)
+        board = self._board(chat_id)
+        if board is None:
+            return
+
+        board.text = None
+        entries = board.entries
+        if user_id in entries:
+            old_points, old_username = entries.pop(user_id)
+            # Everyone outside an incomplete board scores at most its lowest entry
+            if board.complete or points >= old_points or (entries and points >= board.lowest()):
+                entries[user_id] = (points, username or old_username)
+            elif len(entries) < self.limit:
+                # Someone outside the board may now be in the top
+                del self._boards[chat_id]
+            return
+
+        if board.complete or (entries and points > board.lowest()):
+            entries[user_id] = (points, username)
+            self._trim(board)
+
+    def _trim(self, board: ChatBoard):
+        if len(board.entries) <= self.capacity:
+            return
+        for user_id, _ in board.ranked()[self.capacity:]:
+            del board.entries[user_id]
+        board.complete = False
+
+    def track(self, chat_id: int, user_id: int, username: str):
+        """Record a tracked member whose row holds 0 points if it is new"""
+        board = self._board(chat_id)
+        if board is None:
+            self._touch(chat_id)
+            return
+        entries = board.entries
+        if user_id in entries:
+            points, old_username = entries[user_id]
+            if old_username != username:
+                entries[user_id] = (points, username)
+                board.text = None
+                self._touch(chat_id)
+        elif board.complete:
+            # A complete board holds every row, so this one was just inserted
+            entries[user_id] = (0, username)
+            board.text = None
+            self._touch(chat_id)
+            self._trim(board)
+        elif entries and 0 > board.lowest():
+            # A new 0-point row would outrank the board's lowest entry, but
+            # the member may also be an existing row below it; re-warm
+            del self._boards[chat_id]
+            self._touch(chat_id)
+
+    def reset(self, chat_id: int):
+        """Forget a chat after a bulk change to its scores"""
+        self._touch(chat_id)
+        self._boards.pop(chat_id, None)
+
+    def get_text(self, chat_id: int):
+        """Return the rendered leaderboard if it is still current"""
+        board = self._board(chat_id)
+        return board.text if board is not None else None
+
+    def set_text(self, chat_id: int, text: str, version: int):
+        """Cache the rendered leaderboard built at ``version``"""
+        board = self._board(chat_id)
+        if board is not None and self.version(chat_id) == version:
+            board.text = text
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from cache import DelayedFlush
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+class PointLedger:
+    """Group-commit writer for point events.
+
+    Concurrent ``append`` calls are collected for up to ``linger`` seconds (or
+    until ``max_batch`` events are waiting) and written together by
+    ``Database.apply_point_events``: one multi-row append to the ledger and one
+    bulk update of the materialized balances. Each caller gets back its user's
+    balance as of its own event.
+    """
+
+    def __init__(self, db, max_batch: int = 200, linger: float = 0.005,
+                 retention_days: int = 90, compact_interval: float = 3600):
+        self.db = db
+        self.max_batch = max_batch
+        self.linger = linger
+        self.retention = timedelta(days=retention_days)
+        self.compact_interval = compact_interval
+        self._pending = []
+        self._flusher = DelayedFlush(self.flush)
+        self._compact_task = None
+
+    async def append(self, chat_id: int, user_id: int, delta: int,
+                     username: str = None, actor_id: int = None) -> int:
+        """Queue a point event and wait for the user's new balance"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(({
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "delta": delta,
+            "username": username or None,
+            "actor_id": actor_id
+        }, future))
+
+        self._flusher.schedule(0 if len(self._pending) >= self.max_batch else self.linger)
+        return await future
+
+    async def flush(self):
+        """Write every queued event in one transaction"""
+        self._flusher.cancel()
+        if not self._pending:
+            return
+
+        batch, self._pending = self._pending, []
+        try:
+            balances = await self.db.apply_point_events([event for event, _ in batch])
+        except Exception as e:
+            logger.error("Failed to write %s point events: %s", len(batch), e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # Walk back from the final balances so each caller sees the balance
+        # right after its own event
+        for event, future in reversed(batch):
+            key = (event["chat_id"], event["user_id"])
+            if not future.done():
+                future.set_result(balances[key])
+            balances[key] -= event["delta"]
+
+    async def compact(self) -> int:
+        """Roll events older than the retention period into snapshots"""
+        before = datetime.now(timezone.utc) - self.retention
+        return await self.db.compact_ledger(before)
+
+    async def _compact_loop(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                compacted = await self.compact()
+                if compacted:
+                    logger.info("Compacted %s point events into snapshots", compacted)
+            except Exception as e:
+                logger.error("Error compacting point ledger: %s", e)
+
+    def start(self):
+        """Start the periodic compaction task"""
+        if self._compact_task is None:
+            self._compact_task = asyncio.create_task(self._compact_loop())
+
+    async def stop(self):
+        """Stop compaction and write any queued events"""
+        await self._flusher.wait()
+        if self._compact_task is not None:
+            self._compact_task.cancel()
+            try:
+                await self._compact_task
+            except asyncio.CancelledError:
+                pass
+            self._compact_task = None
+        await self.flush()
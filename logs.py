@@ -0,0 +1,92 @@
+"""Logging setup shared by the bot, its worker processes and the tools.
+
+Records are put on an in-memory queue by a QueueHandler and written to
+stderr by a QueueListener thread, so the event loop never waits on the
+stream. High-volume records are tagged with an event type
+(``extra={"event": "message_tracked"}``) and rate limited per type before
+they are queued; untagged records, errors and the ``audit`` logger for
+admin actions always get through.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+import config
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Admin actions: logged at INFO whatever LOG_LEVEL is and never rate limited
+audit = logging.getLogger("audit")
+
+_listener = None
+
+class EventRateLimit(logging.Filter):
+    """Pass at most ``rate`` records per second of each tagged event type.
+
+    The first record let through after a quiet spell reports how many of
+    the same type were dropped before it.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        # event -> [tokens, last refill, records dropped since the last one passed]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, "event", None)
+        if event is None or record.levelno >= logging.ERROR:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(event)
+            if bucket is None:
+                bucket = self._buckets[event] = [self.rate, now, 0]
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            dropped, bucket[2] = bucket[2], 0
+
+        if dropped and isinstance(record.args, tuple):
+            record.msg = f"{record.msg} (%d similar records dropped)"
+            record.args = record.args + (dropped,)
+        return True
+
+def setup(level=None):
+    """Send every log record through the queue; safe to call more than once"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(FORMAT))
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(EventRateLimit(config.LOG_EVENT_RATE))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level or config.LOG_LEVEL)
+    audit.setLevel(logging.INFO)
+    # One INFO line per Bot API request otherwise
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+def shutdown():
+    """Write out the queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,202 @@
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from telegram.ext import ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, labels, value
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels"""
+
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for labels, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", labels + (("le", repr(bound)),), cumulative
+            cumulative += counts[len(self.buckets)]
+            yield f"{self.name}_bucket", labels + (("le", "+Inf"),), cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+
+class Gauge:
+    """Value read from ``callback`` at scrape time.
+
+    The callback returns a number, or a dict mapping label tuples such as
+    ``(("cache", "members"),)`` to numbers. ``metric_type`` can be set to
+    "counter" for monotonic values owned by another object.
+    """
+
+    def __init__(self, name: str, documentation: str, callback, metric_type: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.metric_type = metric_type
+        REGISTRY.append(self)
+
+    def samples(self):
+        value = self.callback()
+        if isinstance(value, dict):
+            for labels, sample in value.items():
+                yield self.name, labels, sample
+        else:
+            yield self.name, (), value
+
+def render() -> str:
+    """Render every registered metric in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+        try:
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        except Exception as e:
+            logger.error("Error collecting metric %s: %s", metric.name, e)
+    return "\n".join(lines) + "\n"
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_duration_seconds", "Time spent in each update handler"
+)
+HANDLER_UPDATES = Counter(
+    "bot_handler_updates_total", "Updates handled, by handler and outcome"
+)
+DB_QUERY_LATENCY = Histogram(
+    "bot_db_query_duration_seconds", "Database statement execution time"
+)
+DB_SLOW_QUERIES = Counter(
+    "bot_db_slow_queries_total", "Statements slower than the slow query threshold"
+)
+DB_POOL_TIMEOUTS = Counter(
+    "bot_db_pool_timeouts_total", "Sessions that timed out waiting for a pooled connection"
+)
+
+def instrument(callback, name: str = None):
+    """Wrap a handler callback with latency and update counters"""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await callback(update, context)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+            HANDLER_UPDATES.inc(handler=name, outcome=outcome)
+
+    return wrapper
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        for nested in handler.entry_points + handler.fallbacks:
+            _instrument_handler(nested)
+        for state_handlers in handler.states.values():
+            for nested in state_handlers:
+                _instrument_handler(nested)
+    elif not getattr(handler.callback, "__wrapped__", None):
+        handler.callback = instrument(handler.callback)
+
+def instrument_application(application):
+    """Wrap every registered handler, including those inside conversations"""
+    for group in application.handlers.values():
+        for handler in group:
+            _instrument_handler(handler)
+
+class MetricsServer:
+    """Minimal HTTP server exposing ``/metrics``"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip the request headers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.split()
+            path = parts[1].split(b"?")[0] if len(parts) > 1 else b""
+            if path == b"/metrics":
+                status, body = "200 OK", render().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+                content_type = "text/plain; charset=utf-8"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error("Error serving metrics: %s", e)
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Serving metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
@@ -0,0 +1,314 @@
+import logging
+from sqlalchemy import (
+    MetaData, Table, Column, Index, Integer, String, BigInteger, DateTime, JSON, text, func
+)
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the Postgres advisory lock that serialises migration runs
+MIGRATION_LOCK_ID = 7_340_115
+
+schema_metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    schema_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now())
+)
+
+async def _index_exists(connection, name: str) -> bool:
+    if connection.dialect.name == "sqlite":
+        return await connection.scalar(
+            text("SELECT COUNT(*) > 0 FROM sqlite_master WHERE type = 'index' AND name = :name"),
+            {"name": name}
+        )
+    return await connection.scalar(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name})
+
+async def _create_user_points(connection):
+    """Create user_points as it was before versioned migrations"""
+    # Frozen copy of the original table so later model changes don't leak in
+    metadata = MetaData()
+    Table(
+        "user_points",
+        metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("chat_id", BigInteger, index=True),
+        Column("user_id", BigInteger, index=True),
+        Column("username", String),
+        Column("points", Integer)
+    )
+    await connection.run_sync(metadata.create_all, checkfirst=True)
+
+async def _add_chat_user_unique_key(connection):
+    """Fold duplicate (chat_id, user_id) rows and add the unique key"""
+    if await _index_exists(connection, "uq_user_points_chat_user"):
+        return
+
+    # Keep the oldest row of each pair with the points of all its duplicates
+    await connection.execute(text("""
+        UPDATE user_points SET points = dupes.total
+        FROM (
+            SELECT MIN(id) AS keep_id, SUM(points) AS total
+            FROM user_points
+            GROUP BY chat_id, user_id
+            HAVING COUNT(*) > 1
+        ) AS dupes
+        WHERE user_points.id = dupes.keep_id
+    """))
+    await connection.execute(text("""
+        DELETE FROM user_points
+        WHERE id NOT IN (SELECT MIN(id) FROM user_points GROUP BY chat_id, user_id)
+    """))
+    await connection.execute(text(
+        "CREATE UNIQUE INDEX uq_user_points_chat_user ON user_points (chat_id, user_id)"
+    ))
+
+async def _add_query_indexes(connection):
+    """Index the leaderboard and username lookups"""
+    # get_top_users: WHERE chat_id = ? ORDER BY points DESC, user_id
+    await connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_user_points_chat_points "
+        "ON user_points (chat_id, points DESC, user_id)"
+    ))
+    # get_user_id_by_username: WHERE chat_id = ? AND username = ?
+    await connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_user_points_chat_username "
+        "ON user_points (chat_id, username)"
+    ))
+    # Every chat_id lookup is now served by one of the composite indexes
+    await connection.execute(text("DROP INDEX IF EXISTS ix_user_points_chat_id"))
+
+async def _add_username_prefix_index(connection):
+    """Index case-insensitive username prefix search for the user picker"""
+    # text_pattern_ops compares byte-wise, which the ~>=~/~<~ range in
+    # Database.get_users_page needs to use the index. SQLite always does.
+    pattern_ops = " text_pattern_ops" if connection.dialect.name == "postgresql" else ""
+    await connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_user_points_chat_username_prefix "
+        f"ON user_points (chat_id, lower(username){pattern_ops})"
+    ))
+
+async def _add_points_ledger(connection):
+    """Create the point event ledger and its compaction snapshots"""
+    metadata = MetaData()
+    Table(
+        "point_events",
+        metadata,
+        Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True),
+        Column("chat_id", BigInteger, nullable=False),
+        Column("user_id", BigInteger, nullable=False),
+        Column("delta", Integer, nullable=False),
+        Column("actor_id", BigInteger),
+        Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+        Index("ix_point_events_chat_user", "chat_id", "user_id", "id"),
+        Index("ix_point_events_created_at", "created_at")
+    )
+    Table(
+        "point_snapshots",
+        metadata,
+        Column("chat_id", BigInteger, primary_key=True),
+        Column("user_id", BigInteger, primary_key=True),
+        Column("points", Integer, nullable=False),
+        Column("as_of", DateTime(timezone=True), nullable=False)
+    )
+    await connection.run_sync(metadata.create_all, checkfirst=True)
+
+    # Balances from before the ledger become the starting snapshots, so
+    # snapshot + events always adds up to user_points.points
+    await connection.execute(text("""
+        INSERT INTO point_snapshots (chat_id, user_id, points, as_of)
+        SELECT chat_id, user_id, points, CURRENT_TIMESTAMP
+        FROM user_points
+        WHERE points <> 0
+    """))
+
+async def _add_chat_admins(connection):
+    """Create the per-chat admin allow-list"""
+    metadata = MetaData()
+    Table(
+        "chat_admins",
+        metadata,
+        Column("chat_id", BigInteger, primary_key=True),
+        Column("user_id", BigInteger, primary_key=True),
+        Column("added_by", BigInteger),
+        Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now())
+    )
+    await connection.run_sync(metadata.create_all, checkfirst=True)
+
+async def _add_persistence(connection):
+    """Create the tables that keep admin conversations across restarts"""
+    metadata = MetaData()
+    Table(
+        "conversation_states",
+        metadata,
+        Column("name", String, primary_key=True),
+        Column("key", String, primary_key=True),
+        Column("state", JSON, nullable=False),
+        Column("updated_at", DateTime(timezone=True), nullable=False, server_default=func.now())
+    )
+    Table(
+        "user_data",
+        metadata,
+        Column("user_id", BigInteger, primary_key=True),
+        Column("data", JSON, nullable=False),
+        Column("updated_at", DateTime(timezone=True), nullable=False, server_default=func.now())
+    )
+    await connection.run_sync(metadata.create_all, checkfirst=True)
+
+async def _add_seasons(connection):
+    """Scope points to per-chat seasons so a reset doesn't rewrite the chat"""
+    metadata = MetaData()
+    Table(
+        "chat_seasons",
+        metadata,
+        Column("chat_id", BigInteger, primary_key=True),
+        Column("season", Integer, nullable=False),
+        Column("started_by", BigInteger),
+        Column("started_at", DateTime(timezone=True), nullable=False, server_default=func.now())
+    )
+    await connection.run_sync(metadata.create_all, checkfirst=True)
+
+    # Existing rows make up season 0; a constant default doesn't rewrite the tables
+    if_not_exists = " IF NOT EXISTS" if connection.dialect.name == "postgresql" else ""
+    for table in ("user_points", "point_events"):
+        await connection.execute(text(
+            f"ALTER TABLE {table} ADD COLUMN{if_not_exists} season INTEGER NOT NULL DEFAULT 0"
+        ))
+    await connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_user_points_chat_season_user "
+        "ON user_points (chat_id, season, user_id)"
+    ))
+    await connection.execute(text("DROP INDEX IF EXISTS uq_user_points_chat_user"))
+    await connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_user_points_chat_season_points "
+        "ON user_points (chat_id, season, points DESC, user_id)"
+    ))
+    await connection.execute(text("DROP INDEX IF EXISTS ix_user_points_chat_points"))
+
+    # Snapshots add up the ledger per season
+    if connection.dialect.name == "sqlite":
+        await _rebuild_sqlite_snapshots(connection)
+        return
+    await connection.execute(text(
+        "ALTER TABLE point_snapshots ADD COLUMN IF NOT EXISTS season INTEGER NOT NULL DEFAULT 0"
+    ))
+    await connection.execute(text("ALTER TABLE point_snapshots DROP CONSTRAINT point_snapshots_pkey"))
+    await connection.execute(text(
+        "ALTER TABLE point_snapshots ADD PRIMARY KEY (chat_id, season, user_id)"
+    ))
+
+async def _rebuild_sqlite_snapshots(connection):
+    """Copy point_snapshots into a table keyed by season; SQLite can't alter a primary key"""
+    metadata = MetaData()
+    Table(
+        "point_snapshots_new",
+        metadata,
+        Column("chat_id", BigInteger, primary_key=True),
+        Column("season", Integer, primary_key=True),
+        Column("user_id", BigInteger, primary_key=True),
+        Column("points", Integer, nullable=False),
+        Column("as_of", DateTime(timezone=True), nullable=False)
+    )
+    await connection.run_sync(metadata.create_all)
+    await connection.execute(text("""
+        INSERT INTO point_snapshots_new (chat_id, season, user_id, points, as_of)
+        SELECT chat_id, 0, user_id, points, as_of FROM point_snapshots
+    """))
+    await connection.execute(text("DROP TABLE point_snapshots"))
+    await connection.execute(text("ALTER TABLE point_snapshots_new RENAME TO point_snapshots"))
+
+async def _key_user_data_by_chat(connection):
+    """Key persisted user_data by user and chat so worker processes don't share rows"""
+    if connection.dialect.name == "sqlite":
+        metadata = MetaData()
+        Table(
+            "user_data_new",
+            metadata,
+            Column("user_id", BigInteger, primary_key=True),
+            Column("chat_id", BigInteger, primary_key=True),
+            Column("data", JSON, nullable=False),
+            Column("updated_at", DateTime(timezone=True), nullable=False, server_default=func.now())
+        )
+        await connection.run_sync(metadata.create_all)
+        await connection.execute(text("""
+            INSERT INTO user_data_new (user_id, chat_id, data, updated_at)
+            SELECT user_id, COALESCE(json_extract(data, '$.chat_id'), 0), data, updated_at
+            FROM user_data
+        """))
+        await connection.execute(text("DROP TABLE user_data"))
+        await connection.execute(text("ALTER TABLE user_data_new RENAME TO user_data"))
+        return
+
+    await connection.execute(text(
+        "ALTER TABLE user_data ADD COLUMN IF NOT EXISTS chat_id BIGINT NOT NULL DEFAULT 0"
+    ))
+    await connection.execute(text(
+        "UPDATE user_data SET chat_id = (data->>'chat_id')::bigint WHERE data->>'chat_id' IS NOT NULL"
+    ))
+    await connection.execute(text("ALTER TABLE user_data DROP CONSTRAINT user_data_pkey"))
+    await connection.execute(text("ALTER TABLE user_data ADD PRIMARY KEY (user_id, chat_id)"))
+
+async def _add_user_season_index(connection):
+    """Index the latest-season lookup of a member's username"""
+    # get_users_page: NOT EXISTS a row WHERE chat_id = ? AND user_id = ? AND season > ?
+    await connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_user_points_chat_user_season "
+        "ON user_points (chat_id, user_id, season)"
+    ))
+
+# Forward-only migrations, applied in order. Never edit one that has shipped;
+# append a new version instead.
+MIGRATIONS = [
+    (1, "create user_points", _create_user_points),
+    (2, "unique key on user_points (chat_id, user_id)", _add_chat_user_unique_key),
+    (3, "composite indexes for leaderboard and username lookups", _add_query_indexes),
+    (4, "username prefix index for the user picker", _add_username_prefix_index),
+    (5, "point event ledger and snapshots", _add_points_ledger),
+    (6, "per-chat admin allow-list", _add_chat_admins),
+    (7, "conversation and user_data persistence", _add_persistence),
+    (8, "per-chat seasons", _add_seasons),
+    (9, "user_data keyed by user and chat", _key_user_data_by_chat),
+    (10, "member index for the latest username per season", _add_user_season_index),
+]
+
+async def _lock(connection):
+    """Serialise migration runs between bot instances"""
+    # On SQLite every write transaction starts with BEGIN IMMEDIATE, which
+    # already holds the database's write lock
+    if connection.dialect.name == "postgresql":
+        await connection.execute(
+            text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID}
+        )
+
+async def current_version(connection) -> int:
+    """Return the highest applied schema version"""
+    version = await connection.scalar(func.max(schema_version.c.version).select())
+    return version or 0
+
+async def migrate(engine) -> int:
+    """Apply pending migrations, each in its own transaction, and return the schema version"""
+    async with engine.begin() as connection:
+        await _lock(connection)
+        await connection.run_sync(schema_metadata.create_all, checkfirst=True)
+        version = await current_version(connection)
+
+    for target, description, apply in MIGRATIONS:
+        if version >= target:
+            continue
+
+        async with engine.begin() as connection:
+            await _lock(connection)
+            # Another instance may have applied it while we waited for the lock
+            if await current_version(connection) >= target:
+                continue
+
+            logger.info("Applying schema migration %s: %s", target, description)
+            await apply(connection)
+            await connection.execute(
+                schema_version.insert().values(version=target, description=description)
+            )
+        version = target
+
+    return version
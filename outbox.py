@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from telegram.constants import BulkRequestLimit
+from telegram.error import RetryAfter
+import metrics
+from cache import DelayedFlush, TTLCache
+
+logger = logging.getLogger(__name__)
+
+FLOOD_WAITS = metrics.Counter(
+    "bot_telegram_flood_waits_total", "Bot API calls rejected with retry_after"
+)
+
+class TokenBucket:
+    """Token bucket refilled continuously at ``rate`` tokens per second.
+
+    ``reserve`` takes a token right away, going into debt if the bucket is
+    empty, so callers are served in the order they asked.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before using it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        """Hold every reservation back for ``seconds``, as asked by a 429"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    # An int or a timedelta depending on the python-telegram-bot settings
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+class Outbox:
+    """Scheduler for outgoing Bot API calls.
+
+    Every call waits for a token from a global bucket and from its chat's
+    bucket, and is retried after the delay Telegram asks for when it hits
+    flood control. Calls don't wait for each other otherwise, so sends to
+    different chats run concurrently. Deletions are queued for ``linger``
+    seconds and sent as one ``deleteMessages`` call per chat and up to 100
+    messages.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 5,
+                 linger: float = 0.5, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # An idle bucket is full again after chat_burst / chat_rate seconds
+        self.chat_buckets = TTLCache(10000, max(60, chat_burst / chat_rate))
+        self.linger = linger
+        self.max_retries = max_retries
+        self.bot = None
+        self._deletes = {}
+        self._flusher = DelayedFlush(self.flush)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        # Refresh the TTL so a blocked bucket isn't dropped while in use
+        self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _acquire(self, chat_id: int):
+        wait = self.global_bucket.reserve()
+        if chat_id is not None:
+            wait = max(wait, self._chat_bucket(chat_id).reserve())
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def send(self, chat_id: int, method, *args, **kwargs):
+        """Call ``method(*args, **kwargs)`` within the rate limits for ``chat_id``"""
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id)
+            try:
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                FLOOD_WAITS.inc()
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                logger.warning("Flood control in chat %s, retrying in %g s", chat_id, delay,
+                               extra={"event": "flood_wait"})
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).block(delay)
+                else:
+                    self.global_bucket.block(delay)
+
+    async def reply(self, message, *args, **kwargs):
+        """Rate-limited ``message.reply_text``"""
+        return await self.send(message.chat_id, message.reply_text, *args, **kwargs)
+
+    async def edit(self, message, *args, **kwargs):
+        """Rate-limited ``message.edit_text``"""
+        return await self.send(message.chat_id, message.edit_text, *args, **kwargs)
+
+    def delete(self, chat_id: int, message_ids: list):
+        """Queue messages for deletion without waiting for it"""
+        self._deletes.setdefault(chat_id, set()).update(message_ids)
+        self._flusher.schedule(self.linger)
+
+    async def _delete_messages(self, chat_id: int, message_ids: list):
+        for start in range(0, len(message_ids), BulkRequestLimit.MAX_LIMIT):
+            chunk = message_ids[start:start + BulkRequestLimit.MAX_LIMIT]
+            try:
+                await self.send(chat_id, self.bot.delete_messages, chat_id, chunk)
+            except Exception as e:
+                logger.error("Error deleting %s messages in chat %s: %s", len(chunk), chat_id, e)
+
+    async def flush(self):
+        """Send every queued deletion, all chats in parallel"""
+        self._flusher.cancel()
+        if not self._deletes:
+            return
+
+        batch, self._deletes = self._deletes, {}
+        await asyncio.gather(*(
+            self._delete_messages(chat_id, sorted(message_ids))
+            for chat_id, message_ids in batch.items()
+        ))
+
+    def start(self, bot):
+        """Attach the bot used for queued deletions"""
+        self.bot = bot
+
+    async def stop(self):
+        """Send the deletions that are still queued"""
+        await self._flusher.wait()
+        await self.flush()
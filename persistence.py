@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+from telegram.ext import BasePersistence, PersistenceInput
+import database
+from cache import DelayedFlush
+
+logger = logging.getLogger(__name__)
+
+class DatabasePersistence(BasePersistence):
+    """Keeps conversation states and user_data in the bot's database.
+
+    The Application hands over its data every ``update_interval`` seconds.
+    Entries are compared with an in-memory copy of what is stored, and only
+    the ones that changed are marked dirty; ``linger`` seconds later all
+    dirty entries are written in one transaction by
+    ``Database.save_persistence``. Users whose data didn't change cost no
+    write at all. Only user_data and conversations are stored: the bot
+    doesn't use chat_data, bot_data or callback data.
+
+    Rows of user_data are keyed by user and by the chat the admin flow was
+    started in (``user_data["chat_id"]``). In multi-worker mode each worker
+    keeps its own user_data for the same user, so this keeps two workers
+    from overwriting one row; ``owns_chat`` tells whether a chat belongs to
+    this worker, and only the state of its own chats is loaded.
+    """
+
+    def __init__(self, db, update_interval: float = 5, linger: float = 0.1, owns_chat=None):
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=update_interval
+        )
+        self.db = db
+        self.linger = linger
+        self.owns_chat = owns_chat
+        # user_id -> JSON of the stored user_data
+        self._user_data = {}
+        # user_id -> chat_id its user_data row is stored under
+        self._user_chats = {}
+        # name -> {JSON key: stored state}
+        self._conversations = {}
+        # Entries waiting to be written, user_data by (user_id, chat_id); None means delete
+        self._dirty_user_data = {}
+        self._dirty_conversations = {}
+        self._flusher = DelayedFlush(self.flush)
+        self._flush_lock = asyncio.Lock()
+
+    async def get_user_data(self) -> dict:
+        # Loaded while the Application initializes, before post_init
+        await database.init_db()
+        user_data = {}
+        for (user_id, chat_id), data in (await self.db.load_user_data()).items():
+            if self.owns_chat is not None and not (chat_id and self.owns_chat(chat_id)):
+                continue
+            if user_id in user_data:
+                # Rows come oldest first; a user has only one user_data per
+                # process, so the newest wins and the older one is dropped
+                self._dirty_user_data[(user_id, self._user_chats[user_id])] = None
+            user_data[user_id] = data
+            self._user_chats[user_id] = chat_id
+        self._user_data = {
+            user_id: json.dumps(data, sort_keys=True) for user_id, data in user_data.items()
+        }
+        if self._dirty_user_data:
+            self._schedule_flush()
+        return user_data
+
+    async def get_conversations(self, name: str) -> dict:
+        await database.init_db()
+        states = await self.db.load_conversations(name)
+        if self.owns_chat is not None:
+            # Conversations are per chat in multi-worker mode, keyed [chat_id, user_id]
+            states = {
+                key: state for key, state in states.items()
+                if len(json.loads(key)) == 2 and self.owns_chat(json.loads(key)[0])
+            }
+        self._conversations[name] = dict(states)
+        return {tuple(json.loads(key)): state for key, state in states.items()}
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        stored = self._conversations.setdefault(name, {})
+        key = json.dumps(list(key))
+        if stored.get(key) == new_state:
+            return
+
+        if new_state is None:
+            stored.pop(key, None)
+        else:
+            stored[key] = new_state
+        self._dirty_conversations[(name, key)] = new_state
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        try:
+            encoded = json.dumps(data, sort_keys=True) if data else None
+        except (TypeError, ValueError) as e:
+            logger.error("Can't persist user_data of %s: %s", user_id, e)
+            return
+        if self._user_data.get(user_id) == encoded:
+            return
+
+        stored_chat = self._user_chats.pop(user_id, None)
+        chat_id = data.get("chat_id", 0) if encoded is not None else None
+        if stored_chat is not None and stored_chat != chat_id:
+            self._dirty_user_data[(user_id, stored_chat)] = None
+        if encoded is None:
+            self._user_data.pop(user_id, None)
+        else:
+            self._user_data[user_id] = encoded
+            self._user_chats[user_id] = chat_id
+            self._dirty_user_data[(user_id, chat_id)] = encoded
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if self._user_data.pop(user_id, None) is not None:
+            self._dirty_user_data[(user_id, self._user_chats.pop(user_id))] = None
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        # The Application passes a whole interval's changes at once, so a
+        # short delay collects them into one write
+        self._flusher.schedule(self.linger)
+
+    async def flush(self) -> None:
+        """Write every dirty entry in one transaction"""
+        self._flusher.cancel()
+
+        async with self._flush_lock:
+            if not self._dirty_user_data and not self._dirty_conversations:
+                return
+
+            user_data, self._dirty_user_data = self._dirty_user_data, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            try:
+                await self.db.save_persistence(
+                    {key: encoded and json.loads(encoded) for key, encoded in user_data.items()},
+                    conversations
+                )
+            except Exception as e:
+                logger.error("Failed to persist %s user_data and %s conversation changes: %s",
+                             len(user_data), len(conversations), e)
+                # Put the batch back without overwriting newer changes
+                for key, encoded in user_data.items():
+                    self._dirty_user_data.setdefault(key, encoded)
+                for key, state in conversations.items():
+                    self._dirty_conversations.setdefault(key, state)
+                # Nothing else may change soon; retry without hammering a database that is down
+                self._flusher.schedule(self.update_interval)
+
+    # chat_data, bot_data and callback data aren't stored
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
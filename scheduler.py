@@ -0,0 +1,118 @@
+import asyncio
+from collections import deque
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class PendingUpdateQueue(asyncio.Queue):
+    """Application update queue that holds back new updates while too many are unprocessed.
+
+    The Application calls ``task_done`` once an update's handlers have
+    finished, so the count covers updates in this queue and those waiting
+    in the update processor. ``put`` waits while ``limit`` of them are
+    unprocessed; the updater and the worker processes await it, so polling,
+    the webhook server and the front process stop taking updates meanwhile.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self._unprocessed = 0
+        self._room = asyncio.Event()
+        self._room.set()
+
+    async def put(self, item) -> None:
+        while self._unprocessed >= self.limit:
+            self._room.clear()
+            await self._room.wait()
+        self.put_nowait(item)
+
+    def put_nowait(self, item) -> None:
+        super().put_nowait(item)
+        self._unprocessed += 1
+
+    def task_done(self) -> None:
+        super().task_done()
+        self._unprocessed -= 1
+        if self._unprocessed < self.limit:
+            self._room.set()
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently while keeping order within a chat and a user.
+
+    Every update waits in a FIFO queue for its chat and for its sender, so
+    updates from different chats run in parallel, while a chat's updates
+    (and an admin's ConversationHandler flow, which is keyed by user) run
+    one at a time in arrival order. At most ``max_concurrent_updates``
+    handlers run at once and up to ``max_pending_updates`` updates are
+    admitted to wait for their turn. The Application doesn't stop at that
+    number by itself; pair it with a PendingUpdateQueue of the same limit.
+    """
+
+    __slots__ = ("_running", "_queues")
+
+    def __init__(self, max_concurrent_updates: int = 32, max_pending_updates: int = 4096):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        # key -> deque of turn futures, the first one is the update running now
+        self._queues = {}
+
+    @staticmethod
+    def ordering_keys(update: object) -> list:
+        """Return the queues an update has to go through, in a fixed order"""
+        if not isinstance(update, Update):
+            return []
+        keys = []
+        if update.effective_chat:
+            keys.append(("chat", update.effective_chat.id))
+        if update.effective_user:
+            keys.append(("user", update.effective_user.id))
+        return keys
+
+    def _enqueue(self, keys: list) -> list:
+        """Take a place in every queue at once and return one turn per queue"""
+        loop = asyncio.get_running_loop()
+        turns = []
+        for key in keys:
+            queue = self._queues.setdefault(key, deque())
+            turn = loop.create_future()
+            if not queue:
+                turn.set_result(None)
+            queue.append(turn)
+            turns.append(turn)
+        return turns
+
+    def _dequeue(self, keys: list, turns: list):
+        """Leave every queue and hand the turn to the next update in line"""
+        for key, turn in zip(keys, turns):
+            queue = self._queues[key]
+            was_first = queue[0] is turn
+            queue.remove(turn)
+            if not queue:
+                del self._queues[key]
+            elif was_first and not queue[0].done():
+                queue[0].set_result(None)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        """Wait for the update's turn in its chat and user queues, then run it"""
+        # Places are taken in every queue before the first await, so arrival
+        # order is the same in all of them and waiting on them can't deadlock
+        keys = self.ordering_keys(update)
+        turns = self._enqueue(keys)
+        started = False
+        try:
+            for turn in turns:
+                await turn
+            async with self._running:
+                started = True
+                await coroutine
+        finally:
+            self._dequeue(keys, turns)
+            if not started and asyncio.iscoroutine(coroutine):
+                # Cancelled while queued; don't leave the coroutine un-awaited
+                coroutine.close()
+
+    async def initialize(self) -> None:
+        """Nothing to set up"""
+
+    async def shutdown(self) -> None:
+        """Nothing to tear down; the application waits for running updates"""
@@ -0,0 +1,130 @@
+"""Export and import a chat's points as CSV or JSON.
+
+    python transfer.py export -1001234567890 --format csv > points.csv
+    python transfer.py import -1001234567890 points.csv
+
+Exports stream rows from a server-side cursor; imports set every listed
+user's balance in one transaction, written in batches.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+
+FIELDS = ("user_id", "username", "points")
+FORMATS = ("csv", "json")
+
+async def export_points(db, chat_id: int, out, fmt: str = "csv") -> int:
+    """Write a chat's points to the text stream ``out`` and return the row count"""
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+        async for row in db.stream_points(chat_id):
+            writer.writerow(row)
+            count += 1
+    else:
+        # One object per line inside the array, written as rows arrive
+        out.write("[")
+        async for row in db.stream_points(chat_id):
+            out.write(",\n" if count else "\n")
+            out.write(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False))
+            count += 1
+        out.write("\n]\n")
+    return count
+
+def _parse_row(record: dict, position: str) -> tuple:
+    try:
+        username = record.get("username") or None
+        return int(record["user_id"]), username and str(username).lstrip("@"), int(record["points"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid row {position}: {e!r}") from None
+
+def read_rows(source, fmt: str = "csv"):
+    """Yield (user_id, username, points) rows from a text stream, raising ValueError on bad input"""
+    if fmt == "csv":
+        reader = csv.DictReader(source)
+        missing = {"user_id", "points"} - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f"Missing CSV columns: {', '.join(sorted(missing))}")
+        for record in reader:
+            yield _parse_row(record, f"on line {reader.line_num}")
+    else:
+        records = json.load(source)
+        if not isinstance(records, list):
+            raise ValueError("Expected a JSON array of objects")
+        for index, record in enumerate(records, 1):
+            if not isinstance(record, dict):
+                raise ValueError(f"Invalid row {index}: expected an object")
+            yield _parse_row(record, str(index))
+
+def detect_format(filename: str) -> str:
+    """Pick the format from a file name, CSV unless it ends in .json"""
+    return "json" if filename and filename.lower().endswith(".json") else "csv"
+
+async def import_points(db, chat_id: int, source, fmt: str = "csv", actor_id: int = None,
+                        progress=None) -> int:
+    """Load rows from the text stream ``source`` into a chat and return the row count"""
+    return await db.import_points(chat_id, read_rows(source, fmt), actor_id, progress=progress)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="write a chat's points to a file or stdout")
+    export.add_argument("chat_id", type=int)
+    export.add_argument("--format", choices=FORMATS, default="csv")
+    export.add_argument("--output", help="file to write, stdout by default")
+
+    load = commands.add_parser("import", help="set a chat's points from a file")
+    load.add_argument("chat_id", type=int)
+    load.add_argument("file", help="CSV or JSON file, - for stdin")
+    load.add_argument("--format", choices=FORMATS, help="detected from the file name by default")
+    return parser.parse_args()
+
+async def run(args):
+    # Imported here so --help works without the bot's environment
+    import database
+    await database.init_db()
+    db = database.Database()
+    try:
+        if args.command == "export":
+            out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+            try:
+                count = await export_points(db, args.chat_id, out, args.format)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+            print(f"Exported {count} rows", file=sys.stderr)
+        else:
+            fmt = args.format or detect_format(args.file)
+
+            def progress(done: int):
+                print(f"\rImported {done} rows...", end="", file=sys.stderr, flush=True)
+
+            source = sys.stdin if args.file == "-" else open(args.file, newline="", encoding="utf-8")
+            try:
+                count = await import_points(db, args.chat_id, source, fmt, progress=progress)
+            finally:
+                if source is not sys.stdin:
+                    source.close()
+            print(f"\rImported {count} rows into chat {args.chat_id}", file=sys.stderr)
+    finally:
+        await database.close_db()
+
+def main():
+    args = parse_args()
+    if not os.environ.get("DATABASE_URL"):
+        sys.exit("DATABASE_URL environment variable is not set")
+    import logs
+    # Progress goes to stderr; only problems are logged
+    logs.setup("WARNING")
+    try:
+        asyncio.run(run(args))
+    except (OSError, ValueError) as e:
+        sys.exit(f"{args.command.capitalize()} failed, nothing was changed: {e}")
+
+if __name__ == "__main__":
+    main()
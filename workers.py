@@ -0,0 +1,143 @@
+"""Multi-process mode.
+
+The front process receives updates (long polling or webhook) and hands
+each one to the worker process that owns its chat, picked by chat_id.
+Every worker runs the full application from bot.py without an updater,
+so a chat's updates, caches and admin conversations all live in a single
+process and workers never race on the same chat.
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+import config
+import logs
+
+logger = logging.getLogger(__name__)
+
+def partition(update: Update, workers: int) -> int:
+    """Return the index of the worker that owns the update's chat"""
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        # Inline queries and the like have no chat
+        key = update.effective_user.id
+    else:
+        return 0
+    return key % workers
+
+async def _serve(index: int, workers: int, updates):
+    # Imported in the worker process only
+    import bot
+
+    if config.METRICS_PORT:
+        # One /metrics endpoint per worker, on consecutive ports
+        bot.metrics_server.port = config.METRICS_PORT + index
+
+    application = bot.build_application(
+        owns_chat=lambda chat_id: chat_id % workers == index,
+        updater=False
+    )
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    logger.info("Worker %s of %s started", index, workers)
+    try:
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                data = await asyncio.to_thread(updates.get, timeout=1)
+            except queue.Empty:
+                if parent is not None and not parent.is_alive():
+                    logger.error("Front process is gone, stopping worker %s", index)
+                    break
+                continue
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.update_queue.join()
+        await application.stop()
+        await application.shutdown()
+        await bot.post_shutdown(application)
+        logger.info("Worker %s stopped", index)
+
+def worker_main(index: int, workers: int, updates):
+    """Entry point of a worker process"""
+    # Ctrl+C and SIGTERM go to the front process, which stops the workers
+    # once it has stopped receiving updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logs.setup()
+    try:
+        asyncio.run(_serve(index, workers, updates))
+    finally:
+        # atexit handlers don't run in multiprocessing children
+        logs.shutdown()
+
+class WorkerPool:
+    """Worker processes and the queues that feed them"""
+
+    def __init__(self, workers: int, max_pending: int = 4096):
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue(max_pending) for _ in range(workers)]
+        self.processes = [
+            context.Process(
+                target=worker_main,
+                args=(index, workers, self.queues[index]),
+                name=f"worker-{index}"
+            )
+            for index in range(workers)
+        ]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    async def dispatch(self, update: Update, context):
+        """Hand an update to the worker that owns its chat"""
+        data = update.to_dict()
+        updates = self.queues[partition(update, len(self.queues))]
+        try:
+            updates.put_nowait(data)
+        except queue.Full:
+            # Back-pressure: wait for the worker without blocking the event loop
+            await asyncio.to_thread(updates.put, data)
+
+    async def stop(self, timeout: float = 60):
+        """Tell every worker to finish its queue and wait for it to exit"""
+        for updates in self.queues:
+            await asyncio.to_thread(updates.put, None)
+        for process in self.processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logger.error("%s didn't stop in %s s, terminating it", process.name, timeout)
+                process.terminate()
+
+def build_front_application(error_handler) -> Application:
+    """Create the front Application that only forwards updates to the workers"""
+    pool = WorkerPool(config.WORKERS, config.MAX_PENDING_UPDATES)
+
+    async def post_init(application):
+        pool.start()
+        logger.info("Started %s worker processes", config.WORKERS)
+
+    async def post_stop(application):
+        # Updates are no longer being received, let the workers drain
+        await pool.stop()
+
+    builder = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    if config.BOT_API_URL:
+        builder = builder.base_url(config.BOT_API_URL)
+    application = builder.build()
+    application.add_error_handler(error_handler)
+    application.add_handler(TypeHandler(Update, pool.dispatch))
+    return application
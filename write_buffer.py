@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from itertools import islice
+from cache import DelayedFlush
+
+logger = logging.getLogger(__name__)
+
+class TrackingBuffer:
+    """Write-behind buffer for member-tracking upserts.
+
+    Rows are collected per (chat_id, user_id), keeping the latest username,
+    and flushed in multi-row upserts of up to ``max_size`` rows when the
+    buffer reaches ``max_size`` or ``flush_interval`` seconds after the first
+    one was queued, whichever comes first. While the database is down at
+    most ``max_pending`` rows are kept; the oldest are dropped beyond that.
+    """
+
+    def __init__(self, db, max_size: int = 500, flush_interval: float = 1.0,
+                 max_pending: int = 10000):
+        self.db = db
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._flusher = DelayedFlush(self.flush)
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, chat_id: int, user_id: int, username: str):
+        """Queue a tracking upsert for the next flush"""
+        self._pending[(chat_id, user_id)] = username
+        self._flusher.schedule(0 if len(self._pending) >= self.max_size else self.flush_interval)
+
+    async def flush(self) -> int:
+        """Write all pending rows, ``max_size`` rows per statement"""
+        self._flusher.cancel()
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+
+            batch, self._pending = self._pending, {}
+            rows = [(chat_id, user_id, username) for (chat_id, user_id), username in batch.items()]
+            written = 0
+            try:
+                # A single statement for a large backlog would pass the
+                # driver's limit on bind parameters
+                for start in range(0, len(rows), self.max_size):
+                    chunk = rows[start:start + self.max_size]
+                    await self.db.upsert_members(chunk)
+                    written += len(chunk)
+                return written
+            except Exception as e:
+                logger.error("Failed to flush %s tracked members: %s", len(rows) - written, e)
+                self._requeue(rows[written:])
+                self._flusher.schedule(self.flush_interval)
+                return written
+
+    def _requeue(self, rows: list):
+        # Unwritten rows go back in front, newer usernames queued since win
+        pending = {(chat_id, user_id): username for chat_id, user_id, username in rows}
+        pending.update(self._pending)
+        self._pending = pending
+
+        excess = len(self._pending) - self.max_pending
+        if excess > 0:
+            for key in list(islice(self._pending, excess)):
+                del self._pending[key]
+            logger.warning("Tracking buffer full, dropped the %s oldest tracked members", excess)
+
+    async def stop(self):
+        """Wait for running flushes and drain the buffer"""
+        await self._flusher.wait()
+        await self.flush()